@@ -0,0 +1,68 @@
+# Synthetic Tolkien-like corpus written as real PDFs, so ingestion runs through pypdf
+import random
+import os
+
+NAMES = [
+    "Frodo", "Gandalf", "Aragorn", "Galadriel", "Tom Bombadil", "Gollum", "Sauron", "Saruman",
+    "Mithrandir", "Strider", "Sméagol", "Sam", "Merry", "Pippin", "Boromir", "Legolas", "Gimli",
+]
+WORDS = (
+    "the ring road shire hobbit mountain river night fire sword elves dwarves orcs tower king journey dark "
+    "light forest bridge horse rider gate stone shadow star wind hill valley west east north south and of "
+    "to in was he she they said upon long ago under over through"
+).split()
+THINGS = ["Glamdring", "Sting", "Anduril", "the One Ring", "the Palantir", "Narsil", "Mithril", "the Phial"]
+
+LINE_LENGTH = 80
+LINES_PER_PAGE = 40
+
+
+def escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def page_lines(rng):
+    words = []
+    while sum(len(w) + 1 for w in words) < LINE_LENGTH * LINES_PER_PAGE:
+        roll = rng.random()
+        words.append(rng.choice(NAMES) if roll < 0.05 else rng.choice(THINGS) if roll < 0.07 else rng.choice(WORDS))
+    lines, line = [], ""
+    for word in words:
+        if len(line) + len(word) + 1 > LINE_LENGTH:
+            lines.append(line)
+            line = ""
+        line = f"{line} {word}".strip()
+    return lines + [line]
+
+
+# Minimal PDF writer: one Helvetica text block per page
+def write_pdf(path, pages):
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    page_refs = []
+    for lines in pages:
+        body = "BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({escape(line)}) '" for line in lines) + " ET"
+        stream = body.encode("cp1252")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        page_refs.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(page_refs)}] /Count {len(page_refs)} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + (obj if isinstance(obj, bytes) else obj.encode("cp1252")) + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+# Write `books` PDFs of `pages` pages each into docs_dir; the same seed gives the same corpus
+def write_corpus(docs_dir, books=3, pages=100, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(docs_dir, exist_ok=True)
+    for book in range(books):
+        write_pdf(os.path.join(docs_dir, f"book_{book + 1}.pdf"), [page_lines(rng) for _ in range(pages)])
@@ -0,0 +1,69 @@
+# Local stand-ins for the OpenAI models so benchmarks run offline and deterministically
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+import numpy as np
+import hashlib
+import re
+import time
+
+FAKE_QUIZ_RESPONSE = """Question: Which road did {word} take out of the Shire?
+Options: A. The East Road, B. The Greenway, C. The Old Forest Road, D. The North Way
+Answer: A"""
+
+FAKE_ANSWER = (
+    "Many are the tales of Middle-earth, and this one speaks of roads and rings, of the Shire and "
+    "of the long dark of Moria, of friends who walk together and of the burden that one of them bears."
+)
+
+
+# Bag-of-words hashing embeddings: similar texts get similar vectors, every
+# call is local and deterministic, and the dimension matches the OpenAI model
+class FakeEmbeddings(Embeddings):
+    model = "fake-embedding"
+
+    def __init__(self, dimension=1536, latency=0.0):
+        self.dimension = dimension
+        self.latency = latency
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            vector[int.from_bytes(digest, "little") % self.dimension] += 1.0
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._embed(text)
+
+
+# Completion model that waits a configurable time before the first token and
+# between tokens, then streams a canned answer (or a well-formed quiz question)
+class FakeLLM(LLM):
+    first_token_latency: float = 0.0
+    token_latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        if "trivia" in prompt:
+            word = hashlib.md5(prompt.encode("utf-8")).hexdigest()[:8]
+            response = FAKE_QUIZ_RESPONSE.format(word=word)
+        else:
+            response = FAKE_ANSWER
+        time.sleep(self.first_token_latency)
+        tokens = re.findall(r"\S+\s*", response)
+        for token in tokens:
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+        return response
@@ -0,0 +1,318 @@
+# Load test: N simulated visitors at a time go through the four page flows (Interview,
+# Expert, Explore and starting a 6-question quiz) against the real engine and OpenAI
+# client. OpenAI is replaced by a local HTTP stand-in (openai_stub.py) with
+# configurable latency and error rate, running in its own process. This process plays
+# one app worker (one Streamlit server), so its resident memory is the memory per worker.
+#
+# Concurrency ramps through the given levels. For each level it reports throughput,
+# latency and time-to-first-token percentiles per flow, error and timeout rates, and
+# the worker's memory:
+#
+#     py benchmarks/load_test.py --concurrency 1,4,16,64 --duration 30
+#     py benchmarks/load_test.py --llm-latency 1.5 --error-rate 0.02 --output load.json
+#     py benchmarks/load_test.py --compare load.json
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from corpus import NAMES, THINGS, WORDS, write_corpus
+from openai_stub import add_arguments
+from run_benchmarks import git_commit, latency_stats, peak_memory
+
+FLOWS = ("interview", "expert", "explore", "quiz")
+EXPLORE_TYPES = ("Character", "Artifact")
+
+
+# Resident memory of this process right now, in MB (Linux only; peak_memory() elsewhere)
+def current_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Run the stand-in in its own process; returns (process, base URL)
+def start_stub(args):
+    command = [sys.executable, os.path.join(BENCH_DIR, "openai_stub.py"), "--seed", str(args.seed)]
+    for name in ("llm_latency", "token_latency", "embed_latency", "jitter", "error_rate", "error_status", "dimension"):
+        command += ["--" + name.replace("_", "-"), str(getattr(args, name))]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().strip()
+    if not url:
+        process.kill()
+        raise RuntimeError("The OpenAI stand-in did not start")
+    return process, url
+
+
+def stub_stats(url):
+    with urllib.request.urlopen(url + "/stats", timeout=10) as response:
+        return json.load(response)
+
+
+# Distinct random questions, or questions drawn from a shared pool when question_pool
+# is set (repeats exercise the answer cache and request coalescing)
+class Questions:
+    def __init__(self, question_pool, seed):
+        rng = random.Random(seed)
+        self.pool = [self.make(rng) for _ in range(question_pool)]
+
+    @staticmethod
+    def make(rng):
+        return " ".join(rng.choice(WORDS + NAMES) for _ in range(10)) + "?"
+
+    def pick(self, rng):
+        return rng.choice(self.pool) if self.pool else self.make(rng)
+
+
+# One visitor: picks a flow, waits for its answer like the page does (streaming
+# tokens into a callback) and keeps Interview and Expert conversations of `turns`
+# questions before starting a new one
+class Session:
+    def __init__(self, number, args, characters, questions):
+        import lotr_engine
+        self.engine = lotr_engine
+        self.rng = random.Random(args.seed * 1000003 + number)
+        self.flows = args.flows
+        self.turns = args.turns
+        self.characters = characters
+        self.questions = questions
+        self.memories = {}
+
+    def memory(self, speaker):
+        memory = self.memories.get(speaker)
+        if memory is None:
+            memory = self.memories[speaker] = self.engine.new_memory(speaker)
+        elif len(memory.turns) >= self.turns:
+            memory.clear()
+        return memory
+
+    # Run one flow: returns (flow, seconds, seconds to first token or None, outcome)
+    def step(self):
+        flow = self.rng.choice(self.flows)
+        first_token = []
+        start = time.perf_counter()
+        callbacks = [self.engine.stream_handler(lambda text: first_token or first_token.append(time.perf_counter()))]
+        outcome = "ok"
+        try:
+            if flow == "interview":
+                character = self.rng.choice(self.characters)
+                result = self.engine.get_character_answer(self.questions.pick(self.rng), character, callbacks, self.memory(character))
+            elif flow == "expert":
+                result = self.engine.get_general_answer(self.questions.pick(self.rng), callbacks, self.memory("Expert"))
+            elif flow == "explore":
+                found = self.engine.explore(self.rng.choice(NAMES + THINGS), self.rng.choice(EXPLORE_TYPES), callbacks)
+                result = found[0] if found else None
+            else:
+                result = self.engine.get_quiz_questions()
+                if len(result) < self.engine.QUIZ_LENGTH:
+                    outcome = "short_quiz"
+            if result == self.engine.TIMEOUT_ANSWER:
+                outcome = "timeout"
+        except Exception as e:
+            outcome = f"error: {type(e).__name__}"
+        elapsed = time.perf_counter() - start
+        return flow, elapsed, first_token[0] - start if first_token else None, outcome
+
+
+# Run `concurrency` sessions for `duration` seconds (flows in progress at the end finish)
+def run_level(args, concurrency, characters, questions, url):
+    import lotr_metrics
+    sessions = [Session(number, args, characters, questions) for number in range(concurrency)]
+    records = []
+    lock = threading.Lock()
+    before = stub_stats(url)
+    counters_before = lotr_metrics.metrics.summary()["counters"]
+    start = time.perf_counter()
+    deadline = start + args.duration
+
+    def visit(session):
+        while time.perf_counter() < deadline:
+            record = session.step()
+            with lock:
+                records.append(record)
+            if args.think_time:
+                time.sleep(session.rng.uniform(0, 2 * args.think_time))
+
+    threads = [threading.Thread(target=visit, args=(session,), name=f"session-{i}") for i, session in enumerate(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    after = stub_stats(url)
+
+    level = {
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 2),
+        "completed": len(records),
+        "throughput_per_second": round(len(records) / elapsed, 2),
+        "flows": {},
+    }
+    for flow in args.flows:
+        flow_records = [record for record in records if record[0] == flow]
+        if not flow_records:
+            continue
+        outcomes = {}
+        for record in flow_records:
+            if record[3] != "ok":
+                outcomes[record[3]] = outcomes.get(record[3], 0) + 1
+        first_tokens = [record[2] for record in flow_records if record[2] is not None]
+        level["flows"][flow] = {
+            "latency": latency_stats([record[1] for record in flow_records]),
+            "time_to_first_token": latency_stats(first_tokens) if first_tokens else None,
+            "failures": outcomes,
+            "failure_rate": round(sum(outcomes.values()) / len(flow_records), 4),
+        }
+    failures = sum(1 for record in records if record[3] != "ok")
+    level["failure_rate"] = round(failures / len(records), 4) if records else None
+    level["worker_memory"] = {"rss_mb": current_memory(), **peak_memory()}
+    level["worker_threads"] = threading.active_count()
+    level["openai"] = {
+        "requests": {name: count - before["requests"].get(name, 0) for name, count in after["requests"].items()},
+        "injected_errors": after["errors"] - before["errors"],
+        "peak_in_flight": after["peak_in_flight"],
+    }
+    counters = lotr_metrics.metrics.summary()["counters"]
+    level["engine"] = {
+        name: sum(values.get(name, 0) - counters_before.get(operation, {}).get(name, 0) for operation, values in counters.items())
+        for name in ("coalesced", "cache_hits", "errors", "degraded", "fallbacks")
+    }
+    return level
+
+
+def run(args, url):
+    import lotr_engine
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "config": vars(args).copy(),
+    }
+    results["config"].pop("output")
+    results["config"].pop("compare")
+
+    # Build the index through the stand-in, then warm up like the app does at start
+    start = time.perf_counter()
+    from lotr_index import CHARACTER_ALIASES
+    lotr_engine.warm_up().join()
+    index = lotr_engine.get_index()
+    characters = [name for name in CHARACTER_ALIASES if index.count(character=name)]
+    questions = Questions(args.question_pool, args.seed)
+    warm_up_args = argparse.Namespace(**{**vars(args), "flows": list(FLOWS)})
+    for flow in FLOWS:
+        session = Session(-1, warm_up_args, characters, questions)
+        session.flows = [flow]
+        session.step()  # builds the chains before anything is measured
+    results["startup_seconds"] = round(time.perf_counter() - start, 2)
+    results["idle_memory"] = {"rss_mb": current_memory(), **peak_memory()}
+
+    results["levels"] = []
+    for concurrency in args.concurrency:
+        level = run_level(args, concurrency, characters, questions, url)
+        results["levels"].append(level)
+        print(summary_line(level), file=sys.stderr, flush=True)
+    return results
+
+
+def summary_line(level):
+    p95 = " ".join(f"{flow}={stats['latency']['p95_ms']:.0f}" for flow, stats in level["flows"].items())
+    return (
+        f"{level['concurrency']:>4} sessions: {level['throughput_per_second']:>7} flows/s, "
+        f"failures {100 * (level['failure_rate'] or 0):.1f}%, rss {level['worker_memory']['rss_mb']} MB, p95 ms {p95}"
+    )
+
+
+# Print how throughput and latencies moved relative to an earlier result file, per concurrency level
+def compare(previous, current):
+    print(f"Comparing against {previous.get('commit') or 'unknown commit'} ({previous.get('timestamp')})")
+    earlier = {level["concurrency"]: level for level in previous.get("levels", [])}
+    for level in current["levels"]:
+        before = earlier.get(level["concurrency"])
+        if before is None:
+            continue
+        rows = [("throughput_per_second", before["throughput_per_second"], level["throughput_per_second"])]
+        rows += [("failure_rate", before["failure_rate"], level["failure_rate"])]
+        rows += [("worker_memory.rss_mb", before["worker_memory"].get("rss_mb"), level["worker_memory"].get("rss_mb"))]
+        for flow, stats in level["flows"].items():
+            if flow in before["flows"]:
+                for stat in ("p50_ms", "p95_ms", "p99_ms"):
+                    rows.append((f"{flow}.{stat}", before["flows"][flow]["latency"][stat], stats["latency"][stat]))
+        for name, old, new in rows:
+            if old is None or new is None:
+                continue
+            change = f"{100 * (new - old) / old:+.1f}%" if old else "n/a"
+            label = f"{level['concurrency']} sessions {name}"
+            print(f"  {label:<45} {old:>10} -> {new:>10}  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the LOTR Companion engine against a local OpenAI stand-in.")
+    parser.add_argument("--concurrency", type=lambda value: [int(n) for n in value.split(",")], default=[1, 2, 4, 8, 16, 32],
+                        help="comma-separated numbers of simultaneous sessions, run in order")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per concurrency level")
+    parser.add_argument("--flows", type=lambda value: value.split(","), default=list(FLOWS),
+                        help=f"comma-separated flows the sessions choose from at random ({','.join(FLOWS)})")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean seconds a session waits between flows")
+    parser.add_argument("--turns", type=int, default=3, help="questions per Interview or Expert conversation")
+    parser.add_argument("--question-pool", type=int, default=0, help="distinct questions shared by all sessions (0: all distinct)")
+    parser.add_argument("--books", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=30, help="pages per book")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-retries", type=int, default=0,
+                        help="retries of failed OpenAI requests in the client (default: 0, so injected errors are not hidden)")
+    add_arguments(parser)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    args = parser.parse_args()
+    unknown = set(args.flows) - set(FLOWS)
+    if unknown:
+        parser.error(f"unknown flows: {', '.join(sorted(unknown))}")
+
+    output = os.path.abspath(args.output) if args.output else None
+    previous_path = os.path.abspath(args.compare) if args.compare else None
+    stub, url = start_stub(args)
+    # The engine reads these when it creates its OpenAI clients
+    os.environ["OPENAI_BASE_URL"] = url
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ["LOTR_EMBEDDING_BACKEND"] = "openai"
+    os.environ["LOTR_OPENAI_MAX_RETRIES"] = str(args.max_retries)
+    # The stand-in does not need texts split to the model's context, so tiktoken's encoding is never downloaded
+    os.environ["LOTR_OPENAI_CHECK_CTX_LENGTH"] = "0"
+    workdir = tempfile.mkdtemp(prefix="lotr-load-")
+    cwd = os.getcwd()
+    try:
+        write_corpus(os.path.join(workdir, "docs"), books=args.books, pages=args.pages, seed=args.seed)
+        # The index and caches use relative paths, so everything lands in the scratch directory
+        os.chdir(workdir)
+        results = run(args, url)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        stub.terminate()
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if previous_path:
+        with open(previous_path) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
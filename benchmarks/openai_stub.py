@@ -0,0 +1,227 @@
+# Local HTTP stand-in for the OpenAI completion and embedding endpoints, for load
+# tests: the real OpenAI client talks to it (set OPENAI_BASE_URL to the printed URL)
+# and it answers with canned completions and hashing embeddings after a configurable
+# latency, failing a configurable fraction of requests with an OpenAI-style error.
+#
+#     py benchmarks/openai_stub.py --port 8089 --llm-latency 0.8 --error-rate 0.01
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FAKE_ANSWER, FAKE_QUIZ_RESPONSE, FakeEmbeddings
+
+ERROR_MESSAGES = {
+    429: ("Rate limit reached (injected by the stand-in)", "rate_limit_exceeded"),
+    500: ("The server had an error while processing your request (injected by the stand-in)", "server_error"),
+    503: ("The engine is currently overloaded (injected by the stand-in)", "server_error"),
+}
+
+
+class StubConfig:
+    def __init__(self, llm_latency=0.5, token_latency=0.01, embed_latency=0.05, jitter=0.2, error_rate=0.0,
+                 error_status=500, dimension=1536, seed=0):
+        self.llm_latency = llm_latency  # seconds before the first token
+        self.token_latency = token_latency  # seconds between streamed tokens
+        self.embed_latency = embed_latency  # seconds per embedding request
+        self.jitter = jitter  # latencies vary uniformly by this fraction either way
+        self.error_rate = error_rate  # fraction of requests answered with error_status
+        self.error_status = error_status
+        self.dimension = dimension
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.embeddings = FakeEmbeddings(dimension=dimension)
+        self.stats = {"requests": {}, "errors": 0, "in_flight": 0, "peak_in_flight": 0}
+
+    def delay(self, seconds):
+        with self.lock:
+            factor = self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+        if seconds > 0:
+            time.sleep(seconds * factor)
+
+    def fail(self):
+        with self.lock:
+            return self.rng.random() < self.error_rate
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+
+# Canned completion for a prompt: a well-formed question for quiz prompts, else an answer
+def completion_text(prompt):
+    if "trivia" in prompt:
+        return FAKE_QUIZ_RESPONSE.format(word=hashlib.md5(prompt.encode("utf-8")).hexdigest()[:8])
+    return FAKE_ANSWER
+
+
+def token_count(text):
+    return len(re.findall(r"\S+", text))
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_chunk(self, data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                self.send_json(200, config.snapshot())
+            else:
+                self.send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+        def do_POST(self):
+            endpoint = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            with config.lock:
+                config.stats["requests"][endpoint] = config.stats["requests"].get(endpoint, 0) + 1
+                config.stats["in_flight"] += 1
+                config.stats["peak_in_flight"] = max(config.stats["peak_in_flight"], config.stats["in_flight"])
+            try:
+                if endpoint not in ("completions", "embeddings"):
+                    self.send_json(404, {"error": {"message": f"Unknown endpoint {self.path}", "type": "invalid_request_error"}})
+                elif config.fail():
+                    with config.lock:
+                        config.stats["errors"] += 1
+                    self.delay_for(endpoint)
+                    message, kind = ERROR_MESSAGES.get(config.error_status, ERROR_MESSAGES[500])
+                    self.send_json(config.error_status, {"error": {"message": message, "type": kind, "code": None}})
+                elif endpoint == "embeddings":
+                    self.embeddings(request)
+                else:
+                    self.completions(request)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client gave up (timeout or cancelled stream)
+            finally:
+                with config.lock:
+                    config.stats["in_flight"] -= 1
+
+        def delay_for(self, endpoint):
+            config.delay(config.embed_latency if endpoint == "embeddings" else config.llm_latency)
+
+        # Inputs are strings or, from langchain_openai, lists of token ids
+        def embeddings(self, request):
+            inputs = request.get("input", [])
+            if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+                inputs = [inputs]
+            texts = [item if isinstance(item, str) else " ".join(map(str, item)) for item in inputs]
+            self.delay_for("embeddings")
+            data = []
+            for i, text in enumerate(texts):
+                vector = config.embeddings.embed_query(text)
+                if request.get("encoding_format") == "base64":
+                    vector = base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+                data.append({"object": "embedding", "index": i, "embedding": vector})
+            tokens = sum(token_count(text) for text in texts)
+            self.send_json(200, {
+                "object": "list", "data": data, "model": request.get("model", "stub"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            })
+
+        def completions(self, request):
+            prompts = request.get("prompt", "")
+            prompts = [prompts] if isinstance(prompts, str) else prompts
+            texts = [completion_text(prompt) for prompt in prompts]
+            created = int(time.time())
+            model = request.get("model", "stub")
+            self.delay_for("completions")
+            if not request.get("stream"):
+                if config.token_latency:
+                    time.sleep(config.token_latency * max(token_count(text) for text in texts))
+                prompt_tokens = sum(token_count(prompt) for prompt in prompts)
+                completion_tokens = sum(token_count(text) for text in texts)
+                self.send_json(200, {
+                    "id": f"cmpl-stub-{created}", "object": "text_completion", "created": created, "model": model,
+                    "choices": [{"text": text, "index": i, "logprobs": None, "finish_reason": "stop"} for i, text in enumerate(texts)],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+                })
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            tokens = re.findall(r"\S+\s*", texts[0]) + [""]
+            for i, token in enumerate(tokens):
+                if i and config.token_latency:
+                    config.delay(config.token_latency)
+                chunk = {
+                    "id": f"cmpl-stub-{created}", "object": "text_completion", "created": created, "model": model,
+                    "choices": [{"text": token, "index": 0, "logprobs": None, "finish_reason": "stop" if i == len(tokens) - 1 else None}],
+                }
+                self.send_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+    return Handler
+
+
+# Start the stand-in on a daemon thread; returns the server (server.server_address[1] is the port)
+def serve(config, port=0, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="openai-stub", daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds before the first completion token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="seconds between completion tokens")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per embedding request")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latencies vary uniformly by this fraction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, choices=sorted(ERROR_MESSAGES), default=500)
+    parser.add_argument("--dimension", type=int, default=1536, help="embedding dimension")
+
+
+def config_from_args(args):
+    return StubConfig(
+        llm_latency=args.llm_latency, token_latency=args.token_latency, embed_latency=args.embed_latency,
+        jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status, dimension=args.dimension,
+        seed=getattr(args, "seed", 0),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI completion and embedding endpoints.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--seed", type=int, default=0)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = serve(config_from_args(args), args.port, args.host)
+    host, port = server.server_address[:2]
+    print(f"http://{host}:{port}/v1", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
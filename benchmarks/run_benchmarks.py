@@ -0,0 +1,237 @@
+# Offline benchmarks for ingestion, retrieval and end-to-end answers.
+#
+# Runs against a synthetic PDF corpus with a local fake embedding model and a
+# fake LLM with configurable latency, so no network or API key is needed and
+# numbers are comparable across commits:
+#
+#     py benchmarks/run_benchmarks.py --output bench.json
+#     py benchmarks/run_benchmarks.py --compare bench.json
+import numpy as np
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from corpus import NAMES, THINGS, WORDS, write_corpus
+from fakes import FakeEmbeddings, FakeLLM
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def latency_stats(samples):
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "mean_ms": round(1000 * sum(values) / len(values), 3),
+        "p50_ms": round(1000 * percentile(values, 0.50), 3),
+        "p95_ms": round(1000 * percentile(values, 0.95), 3),
+        "p99_ms": round(1000 * percentile(values, 0.99), 3),
+    }
+
+
+def timed(fn, inputs):
+    samples = []
+    for args in inputs:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return latency_stats(samples)
+
+
+# Peak resident memory in MB of this process and of its (ingestion) child processes
+def peak_memory():
+    if resource is None:
+        return {}
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KB elsewhere
+    return {
+        "self_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    import lotr_engine
+    import lotr_index
+    from lotr_embeddings import CachedEmbeddings
+    from lotr_shards import ShardedIndex
+
+    rng = random.Random(args.seed)
+    embeddings = CachedEmbeddings(FakeEmbeddings(dimension=args.dimension, latency=args.embed_latency))
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "config": vars(args).copy(),
+    }
+    results["config"].pop("output")
+    results["config"].pop("compare")
+
+    # Ingestion: a cold build of every shard (empty embedding cache), a rebuild served
+    # from the embedding cache, and loading the saved shards from disk
+    start = time.perf_counter()
+    index = ShardedIndex(embeddings).load()
+    cold_build = time.perf_counter() - start
+    chunks = index.count()
+    pages = args.books * args.pages
+
+    shutil.rmtree(lotr_index.SHARDS_DIR)
+    start = time.perf_counter()
+    ShardedIndex(embeddings).load()
+    cached_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ShardedIndex(embeddings).load()
+    load = time.perf_counter() - start
+
+    results["ingestion"] = {
+        "pages": pages,
+        "chunks": chunks,
+        "build_seconds": round(cold_build, 3),
+        "cached_rebuild_seconds": round(cached_build, 3),
+        "load_seconds": round(load, 3),
+        "pages_per_second": round(pages / cold_build, 1),
+        "chunks_per_second": round(chunks / cold_build, 1),
+    }
+
+    lotr_engine.configure(
+        embeddings=embeddings,
+        llm=lambda **kwargs: FakeLLM(first_token_latency=args.llm_latency, token_latency=args.token_latency),
+    )
+    index = lotr_engine.get_index().load()
+
+    # Distinct random questions so the semantic answer cache does not serve them
+    def question():
+        return " ".join(rng.choice(WORDS + NAMES) for _ in range(10)) + "?"
+
+    characters = [name for name in lotr_index.CHARACTER_ALIASES if index.count(character=name)]
+    first_book = index.books[:1]
+    queries = [(question(),) for _ in range(args.queries)]
+    character_queries = [(question(), rng.choice(characters)) for _ in range(args.queries)]
+    names = [(rng.choice(NAMES + THINGS),) for _ in range(args.queries)]
+
+    results["retrieval"] = {
+        "general": timed(lambda q: index.similarity_search_with_score(q, k=5), queries),
+        "character": timed(lambda q, c: index.similarity_search_with_score(q, k=10, character=c), character_queries),
+        "one_book": timed(lambda q: index.similarity_search_with_score(q, k=5, books=first_book), queries),
+        "lexical": timed(lambda n: index.hybrid_search(n, None), names),
+        "explore": timed(lotr_engine.get_explore_context, names),
+    }
+
+    # Quantized copies of the flat shards: size, recall against the flat shards (weighted
+    # by shard size) and the latency of searching every shard in turn
+    query_embeddings = [(np.array([embeddings.embed_query(q)], dtype=np.float32),) for q, in queries]
+    flats = [shard.index.index for shard in index.select() if shard.index is not None]
+    results["compression"] = {"flat": {
+        "code_bytes": sum(flat.ntotal * flat.d * 4 for flat in flats),
+        "search": timed(lambda e: [flat.search(e, 5) for flat in flats], query_embeddings),
+    }}
+    for compression in ("fp16", "sq8", "ivfpq"):
+        compressed = [lotr_index.compress_index(flat, compression) for flat in flats]
+        recall = sum(lotr_index.recall_at_k(flat, shard) * flat.ntotal for flat, shard in zip(flats, compressed)) / chunks
+        results["compression"][compression] = {
+            "code_bytes": sum(shard.sa_code_size() * shard.ntotal for shard in compressed),
+            f"recall_at_{lotr_index.RECALL_K}": round(recall, 4),
+            "search": timed(lambda e: [shard.search(e, 5) for shard in compressed], query_embeddings),
+        }
+
+    # Build the chains (first use imports LangChain) before anything is timed
+    lotr_engine.get_general_answer(question())
+    lotr_engine.get_character_answer(question(), characters[0])
+    lotr_engine.explore(names[0][0], "Character")
+    lotr_engine.get_quiz_question()
+
+    e2e_count = max(1, args.queries // 5)
+    results["end_to_end"] = {
+        "get_general_answer": timed(lotr_engine.get_general_answer, [(question(),) for _ in range(e2e_count)]),
+        "get_character_answer": timed(lotr_engine.get_character_answer, [(question(), rng.choice(characters)) for _ in range(e2e_count)]),
+        "get_quiz_question": timed(lotr_engine.get_quiz_question, [()] * e2e_count),
+        "explore": timed(lotr_engine.explore, [(rng.choice(NAMES + THINGS), rng.choice(["Character", "Artifact"])) for _ in range(e2e_count)]),
+    }
+    results["answer_cache"] = lotr_engine.get_answer_cache().stats()
+    results["memory"] = peak_memory()
+    return results
+
+
+# Print how latencies and build times moved relative to an earlier result file
+def compare(previous, current):
+    print(f"Comparing against {previous.get('commit') or 'unknown commit'} ({previous.get('timestamp')})")
+    rows = [("ingestion", key, None) for key in ("build_seconds", "cached_rebuild_seconds", "load_seconds")]
+    rows += [(section, name, "p50_ms") for section in ("retrieval", "end_to_end") for name in current[section]]
+    rows += [(section, name, "p95_ms") for section in ("retrieval", "end_to_end") for name in current[section]]
+    for section, name, stat in rows:
+        try:
+            before = previous[section][name] if stat is None else previous[section][name][stat]
+        except KeyError:
+            continue
+        after = current[section][name] if stat is None else current[section][name][stat]
+        change = f"{100 * (after - before) / before:+.1f}%" if before else "n/a"
+        label = f"{section}.{name}" + (f".{stat}" if stat else "")
+        print(f"  {label:<45} {before:>10} -> {after:>10}  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline LOTR Companion benchmarks (fake embeddings and LLM, synthetic corpus).")
+    parser.add_argument("--books", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=150, help="pages per book")
+    parser.add_argument("--queries", type=int, default=200, help="retrieval queries per path (end-to-end runs a fifth of that)")
+    parser.add_argument("--dimension", type=int, default=1536, help="embedding dimension")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="seconds per fake embedding call")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds before the fake LLM's first token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between fake LLM tokens")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    previous_path = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix="lotr-bench-")
+    cwd = os.getcwd()
+    try:
+        write_corpus(os.path.join(workdir, "docs"), books=args.books, pages=args.pages, seed=args.seed)
+        # The index and caches use relative paths, so everything lands in the scratch directory
+        os.chdir(workdir)
+        results = run(args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if previous_path:
+        with open(previous_path) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Semantic answer cache: reuse an answer when a new question is close enough to one already answered
+import numpy as np
+import sqlite3
+import threading
+import time
+
+ANSWER_CACHE_PATH = "answer_cache.sqlite"
+ANSWER_CACHE_THRESHOLD = 0.95  # cosine similarity needed to reuse an answer
+ANSWER_CACHE_TTL_SECONDS = 7 * 24 * 3600
+ANSWER_CACHE_MAX_ENTRIES = 5000
+
+
+# Answers are stored per scope (e.g. "expert" or "character:Gandalf") with the
+# embedding of the question that produced them. Entries expire after a TTL and
+# the least recently used ones are evicted beyond the size limit. Everything is
+# kept in SQLite so the cache survives restarts; lookups use in-memory matrices.
+class SemanticAnswerCache:
+    def __init__(self, path=ANSWER_CACHE_PATH, threshold=ANSWER_CACHE_THRESHOLD,
+                 ttl=ANSWER_CACHE_TTL_SECONDS, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers (id INTEGER PRIMARY KEY, scope TEXT NOT NULL, vector BLOB NOT NULL, "
+            "answer TEXT NOT NULL, context TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.commit()
+        # scope -> (row ids, matrix of normalized question embeddings)
+        self._scopes = {}
+        with self._lock:
+            self._expire(time.time())
+            for scope, in self._conn.execute("SELECT DISTINCT scope FROM answers").fetchall():
+                self._reload(scope)
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _reload(self, scope):
+        rows = self._conn.execute("SELECT id, vector FROM answers WHERE scope = ?", (scope,)).fetchall()
+        if rows:
+            self._scopes[scope] = ([row_id for row_id, _ in rows], np.stack([np.frombuffer(v, dtype=np.float32) for _, v in rows]))
+        else:
+            self._scopes.pop(scope, None)
+
+    def _expire(self, now):
+        deleted = self._conn.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl,)).rowcount
+        self._conn.commit()
+        return deleted
+
+    # Return (answer, context) for the closest cached question in the scope, if close enough
+    def lookup(self, scope, query_embedding):
+        now = time.time()
+        with self._lock:
+            entry = self._scopes.get(scope)
+            if entry is not None:
+                ids, matrix = entry
+                similarities = matrix @ self._normalize(query_embedding)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    row = self._conn.execute(
+                        "SELECT answer, context, created FROM answers WHERE id = ?", (ids[best],)
+                    ).fetchone()
+                    if row is not None and row[2] >= now - self.ttl:
+                        self._conn.execute("UPDATE answers SET last_used = ? WHERE id = ?", (now, ids[best]))
+                        self._conn.commit()
+                        self.hits += 1
+                        return row[0], row[1]
+                    # The closest answer expired (or was evicted by another process): drop stale entries
+                    self._expire(now)
+                    for cached_scope in list(self._scopes):
+                        self._reload(cached_scope)
+            self.misses += 1
+            return None
+
+    def store(self, scope, query_embedding, answer, context=""):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO answers (scope, vector, answer, context, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (scope, self._normalize(query_embedding).tobytes(), answer, context, now, now),
+            )
+            # Evict the least recently used answers beyond the size limit
+            evicted = self._conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+            self._conn.commit()
+            if evicted:
+                for cached_scope in list(self._scopes):
+                    self._reload(cached_scope)
+            self._reload(scope)
+
+    def stats(self):
+        with self._lock:
+            entries = sum(len(ids) for ids, _ in self._scopes.values())
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
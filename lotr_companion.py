@@ -1,244 +1,38 @@
 # Import necessary libraries
-from langchain_community.document_loaders import DirectoryLoader
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-from langchain.prompts import PromptTemplate
-from langchain.chains.question_answering import load_qa_chain
-from langchain_openai import OpenAI
-from dotenv import load_dotenv
 import streamlit as st
-import random
-
-load_dotenv()
+import lotr_engine as engine
+import lotr_metrics
+import os
 
 # Set page configuration
 st.set_page_config(page_title="LOTR Companion", layout="wide")
 
-# Cache FAISS loading to avoid reloading on every run
+# Load the index and pre-generate quiz questions in the background; the page
+# renders right away and the first call that needs them waits for them
+engine.warm_up()
+
+# Export metrics once per process: Prometheus text on LOTR_METRICS_PORT (of LOTR_METRICS_HOST,
+# localhost by default), JSON lines to LOTR_METRICS_LOG
 @st.cache_resource
-def load_faiss():
-    loader = DirectoryLoader(f'docs', glob="./*.pdf", loader_cls=PyPDFLoader)
-    documents = loader.load()
-    chunk_size_value = 1000
-    chunk_overlap = 100
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size_value, chunk_overlap=chunk_overlap, length_function=len)
-
-    # General embeddings:
-    general_texts = text_splitter.split_documents(documents)
-    general_faiss = FAISS.from_documents(general_texts, OpenAIEmbeddings())
-    general_faiss.save_local("general_faiss_index")
-    general_faiss = FAISS.load_local("general_faiss_index", OpenAIEmbeddings(), allow_dangerous_deserialization=True)
-
-    # With character tags: split documents and add metadata
-    texts = []
-    for doc in documents:
-        chunks = text_splitter.split_documents([doc])
-        for chunk in chunks:
-            # Heuristically tag metadata (e.g., look for mentions of characters)
-            character_tags = []
-            if "Frodo" in chunk.page_content:
-                character_tags.append("Frodo")
-            if "Gandalf" in chunk.page_content:
-                character_tags.append("Gandalf")
-            if "Aragorn" in chunk.page_content:
-                character_tags.append("Aragorn")
-            if "Galadriel" in chunk.page_content:
-                character_tags.append("Galadriel")
-            if "Tom Bombadil" in chunk.page_content:
-                character_tags.append("Tom Bombadil")
-            if "Gollum" in chunk.page_content:
-                character_tags.append("Gollum")
-            if "Sauron" in chunk.page_content:
-                character_tags.append("Sauron")
-            if "Saruman" in chunk.page_content:
-                character_tags.append("Saruman")
-
-            chunk.metadata = {"characters": character_tags}
-            texts.append(chunk)
-    
-    char_faiss = FAISS.from_documents(texts, OpenAIEmbeddings())
-    char_faiss.save_local("llm_faiss_index")
-    char_faiss = FAISS.load_local("llm_faiss_index", OpenAIEmbeddings(), allow_dangerous_deserialization=True)
-    return char_faiss, general_faiss
-
-char_faiss, general_faiss = load_faiss()
-
-# Define character-specific prompt
-char_prompt_template = """You are roleplaying as {character}, a key figure in 'The Lord of the Rings.' Respond in the style and tone of {character}.
-
-Use only the provided context to answer the question. If the context does not contain relevant information, respond as {character} would, acknowledging that you don't know the answer.
-
-Context:
----------
-{context}
----------
-Question: {question}
-Helpful Answer:"""
-
-CHAR_PROMPT = PromptTemplate(
-    template=char_prompt_template,
-    input_variables=["context", "question", "character"]
-)
-
-# Load character-specific QA Chain
-def load_char_chain():
-    return load_qa_chain(OpenAI(temperature=0), chain_type="stuff", prompt=CHAR_PROMPT)
-
-char_chain = load_char_chain()
-
-# Define general prompt
-general_prompt_template = """You are an expert on 'The Lord of the Rings' lore. Answer questions about Middle-earth using the provided context. If you don't know the answer, just say you don't know.
-
-Context:
----------
-{context}
----------
-Question: {question}
-Helpful Answer:"""
-
-general_prompt = PromptTemplate(
-    template=general_prompt_template,
-    input_variables=["context", "question"]
-)
-
-# Load general QA Chain
-def load_general_chain():
-    return load_qa_chain(OpenAI(temperature=0), chain_type="stuff", prompt=general_prompt)
-
-general_chain = load_general_chain()
-
-# Define quiz prompt
-quiz_prompt_template = """You are generating trivia questions about 'The Lord of the Rings.' 
-    Generate one multiple-choice question with 4 options (A, B, C, D) and specify the correct answer. 
-    Example format:
-    Question: [Your question here]
-    Options: A. [option1], B. [option2], C. [option3], D. [option4]
-    Answer: [one of [option1], [option2], [option3] or [option4]]
-
-    Context:
-    ---------
-    {context}
-    ---------
-    Generate one trivia question:
-    """
-
-quiz_prompt = PromptTemplate(
-    template=quiz_prompt_template,
-    input_variables=["context"]
-)
-
-# Load quiz QA Chain
-def load_quiz_chain():
-    return load_qa_chain(OpenAI(temperature=0), chain_type="stuff", prompt=quiz_prompt)
-
-quiz_chain = load_quiz_chain()
-
-# Define character/artifact analysis prompt
-
-
-
-# Function to get answers based on the selected character
-def get_character_answer(query, character):
-    # Retrieve chunks using FAISS
-    relevant_chunks = char_faiss.similarity_search_with_score(query, k=10)
-    
-    # Filter chunks for the selected character
-    filtered_chunks = [
-        chunk[0] for chunk in relevant_chunks if character in chunk[0].metadata.get("characters", [])
-    ]
-    
-    # If no filtered chunks are found, return a fallback response
-    if not filtered_chunks:
-        return f"Sorry, I am not sure."
-    
-    # Prepare inputs for the chain
-    context = "\n".join([doc.page_content for doc in filtered_chunks])
-    results = char_chain({
-        "input_documents": filtered_chunks,
-        "context": context,
-        "question": query,
-        "character": character
-    })
-    return results["output_text"]
-
-def get_general_answer(query):
-    # Retrieve chunks using the general FAISS index
-    relevant_chunks = general_faiss.similarity_search_with_score(query, k=5)
-    context = "\n".join([doc[0].page_content for doc in relevant_chunks])
-    results = general_chain({
-        "input_documents": [doc[0] for doc in relevant_chunks],
-        "context": context,
-        "question": query
-    })
-    return results["output_text"], context
-
-def get_quiz_question():
-    # Get multiple random chunks to increase variety
-    query = "Random trivia for LOTR"
-    relevant_chunks = general_faiss.similarity_search_with_score(query, k=10)
-    # Randomly select one chunk
-    selected_chunk = random.choice(relevant_chunks)
-    context = selected_chunk[0].page_content
-
-    # Generate a trivia question
-    results = quiz_chain({
-        "input_documents": [selected_chunk[0]],
-        "context": context
-    })
-    response = results["output_text"]
-
-    try:
-        # More robust parsing
-        question = ""
-        options = []
-        correct_answer = ""
-        
-        lines = [line.strip() for line in response.split("\n") if line.strip()]
-        for line in lines:
-            if line.startswith("Question:"):
-                question = line.replace("Question:", "").strip()
-            elif line.startswith("Options:"):
-                # Split by the option letters (A., B., C., D.) instead of commas
-                options_text = line.replace("Options:", "").strip()
-                # Use regex or string operations to split by A., B., C., D.
-                option_parts = []
-                for prefix, next_prefix in [("A.", "B."), ("B.", "C."), ("C.", "D."), ("D.", None)]:
-                    try:
-                        start = options_text.index(prefix)
-                        if next_prefix:
-                            try:
-                                end = options_text.index(next_prefix)
-                                option = options_text[start:end].strip()
-                            except ValueError:
-                                option = options_text[start:].strip()
-                        else:
-                            option = options_text[start:].strip()
-                        
-                        # Remove trailing comma if it exists
-                        if option.endswith(','):
-                            option = option[:-1].strip()
-                            
-                        option_parts.append(option)
-                    except ValueError:
-                        continue
-                options = option_parts
-            elif line.startswith("Answer:"):
-                correct_answer = line.replace("Answer:", "").strip()
-
-        if not question or not options or not correct_answer or len(options) != 4:
-            raise ValueError(f"Invalid quiz question response")
-
-        return question, options, correct_answer
-
-    except Exception as e:
-        # Provide a fallback question if parsing fails
-        return (
-            "Who is the author of The Lord of the Rings?",
-            ["A. J.R.R. Tolkien", "B. C.S. Lewis", "C. George R.R. Martin", "D. Terry Pratchett"],
-            "A"
-        )
+def start_metrics_exports():
+    if os.getenv("LOTR_METRICS_LOG"):
+        lotr_metrics.log_to_file(os.getenv("LOTR_METRICS_LOG"))
+    if os.getenv("LOTR_METRICS_PORT"):
+        return lotr_metrics.serve_prometheus(int(os.getenv("LOTR_METRICS_PORT")), os.getenv("LOTR_METRICS_HOST", "127.0.0.1"))
+
+start_metrics_exports()
+
+# Render an answer into a placeholder token by token as it is generated
+def stream_into(placeholder, template="{text}"):
+    return [engine.stream_handler(lambda text: placeholder.markdown(template.format(text=text.strip())))]
+
+# This session's memory of its conversation with a character or the expert
+def conversation_memory(speaker):
+    memories = st.session_state.setdefault("memory", {})
+    if speaker not in memories:
+        memories[speaker] = engine.new_memory(speaker)
+    return memories[speaker]
+
 #Streamlit UI
 
 def style_sidebar():
@@ -361,6 +155,29 @@ st.markdown('<div class="main_title">Lord of the Rings Companion</div>', unsafe_
 
 page = st.sidebar.radio("Navigate", ["Interview a Character", "Talk with an Expert", "Explore a Character or Artifact", "Test Your LOTR Knowledge"])
 
+# Answers can be limited to some of the books, e.g. to avoid spoilers (the quiz uses all of them)
+all_books = engine.get_books()
+selected_books = st.sidebar.multiselect("Books", all_books, default=all_books, format_func=lambda name: os.path.splitext(name)[0])
+books = selected_books if selected_books and len(selected_books) < len(all_books) else None
+
+# Operator view: only shown when the URL has ?admin=<LOTR_ADMIN_KEY>
+def admin_panel():
+    summary = lotr_metrics.metrics.summary()
+    with st.sidebar.expander("Operator metrics", expanded=True):
+        st.markdown("**Stage latency**")
+        st.dataframe(summary["stages"], hide_index=True)
+        st.markdown("**Counters**")
+        st.json(summary["counters"])
+        st.markdown("**Answer cache**")
+        st.json(engine.get_answer_cache().stats())
+        st.markdown("**Recent requests**")
+        st.dataframe(list(reversed(summary["recent"]))[:20], hide_index=True)
+        st.download_button("Download Prometheus metrics", lotr_metrics.metrics.prometheus(), file_name="lotr_metrics.prom")
+        st.download_button("Download traces (JSON lines)", lotr_metrics.metrics.json_lines(), file_name="lotr_traces.jsonl")
+
+if os.getenv("LOTR_ADMIN_KEY") and st.query_params.get("admin") == os.getenv("LOTR_ADMIN_KEY"):
+    admin_panel()
+
 if page == "Interview a Character":
     st.markdown('<div class="title">Chat with a Lord of the Rings Character</div>', unsafe_allow_html=True)
 
@@ -397,12 +214,29 @@ if page == "Interview a Character":
         st.session_state["conversation"] = []
 
     query = st.text_input(f"Ask {character} a question:")
-    if query:
-        answer = get_character_answer(query, character)
+    # The script reruns on every interaction: ask each new question only once
+    if query and st.session_state.get("interview_question") != (character, query, books):
+        st.session_state["interview_question"] = (character, query, books)
+        # Stream the answer under the question as it is generated, then move both into the history
+        turn = st.empty()
+        with turn.container():
+            st.markdown(f"**You: {query}**")
+            answer_placeholder = st.empty()
+        answer = engine.get_character_answer(
+            query, character,
+            callbacks=stream_into(answer_placeholder, f"*{character}: {{text}}*"),
+            memory=conversation_memory(character),
+            books=books
+        )
+        turn.empty()
         st.session_state["conversation"].append((f"You: {query}", f"{character}: {answer}"))
 
     if st.button("Clear Conversation History"):
+        # The history shown is shared by all characters, so every interview memory is cleared
         st.session_state["conversation"] = []
+        for speaker, memory in st.session_state.get("memory", {}).items():
+            if speaker != "Expert":
+                memory.clear()
 
     # Display conversation history
     for user, bot in reversed(st.session_state["conversation"]):
@@ -414,14 +248,23 @@ elif page == "Talk with an Expert":
 
     query = st.text_input("Ask a question about Middle-Earth:")
     if query:
-        answer, context = get_general_answer(query)
-
         st.subheader("Answer")
-        st.write(answer)
+        answer_placeholder = st.empty()
+        # Ask each new question once; reruns show the last answer again
+        if st.session_state.get("expert_answer", (None,))[0] != (query, books):
+            answer, context = engine.get_general_answer(
+                query, callbacks=stream_into(answer_placeholder), memory=conversation_memory("Expert"), books=books
+            )
+            st.session_state["expert_answer"] = ((query, books), answer, context)
+        _, answer, context = st.session_state["expert_answer"]
+        answer_placeholder.write(answer)
    
         st.subheader("Retrieved Context")
         st.write(context)
 
+    if st.button("Start a New Conversation"):
+        conversation_memory("Expert").clear()
+
 
 elif page == "Test Your LOTR Knowledge":
     st.markdown('<div class="title">Test Your LOTR Knowledge</div>', unsafe_allow_html=True)
@@ -445,22 +288,8 @@ elif page == "Test Your LOTR Knowledge":
 
     # Generate questions only once when starting/restarting
     if not st.session_state.quiz_state["initialized"]:
-        questions = []
-        used_questions = set()  # Track used questions to avoid duplicates
-        
-        # Try to generate 6 unique questions
-        attempts = 0
-        while len(questions) < 6 and attempts < 20:  # Limit attempts to prevent infinite loop
-            question, options, correct_answer = get_quiz_question()
-            # Create a unique key for the question to check duplicates
-            question_key = (question, tuple(options))
-            
-            if question_key not in used_questions:
-                questions.append((question, options, correct_answer))
-                used_questions.add(question_key)
-            attempts += 1
-
-        st.session_state.quiz_state["questions"] = questions
+        # Take 6 unique questions from the shared, pre-generated pool
+        st.session_state.quiz_state["questions"] = engine.get_quiz_questions()
         st.session_state.quiz_state["initialized"] = True
 
     # Get current question
@@ -531,64 +360,32 @@ elif page == "Explore a Character or Artifact":
             if not input_name:
                 st.error(f"Please enter the name of a {explore_type.lower()} to analyze.")
             else:
-                # Retrieve relevant text using FAISS
-                relevant_chunks = general_faiss.similarity_search_with_score(input_name, k=4)
-                
-                if not relevant_chunks:
-                    st.warning(f"No information found for {input_name}. Try another name.")
-                else:
-                    # Combine the retrieved chunks
-                    context = "\n\n".join([chunk[0].page_content for chunk in relevant_chunks])
-                    max_context_length = 2250
-                    if len(context) > max_context_length:
-                        context = context[:max_context_length]
-                    # Use Langchain's chain system to analyze
-                    if explore_type == "Character":
-                        analysis_prompt_template = """You are an expert on 'The Lord of the Rings.' Provide an analysis of the character '{name}' based on the following context. Always respond in the example format below, and always summarize your response in 200 words or less.
-                        (Example format:
-                        History: []
-                        Significance: []
-                        Powers: [])
-
-                        Context:
-                        {context}
-
-                        Analysis (summarize in 200 words or less):"""
-                    elif explore_type == "Artifact":
-                        analysis_prompt_template = """You are an expert on 'The Lord of the Rings.' Provide an analysis of the artifact '{name}' based on the following context. Always respond in the example format below, and always summarize your response in 200 words or less.
-                        (Example format:
-                        History: []
-                        Significance: []
-                        Associated Characters: [])
-
-                        Context:
-                        {context}
-
-                        Explanation (max 200 words):"""
-
-                    # Langchain PromptTemplate
-                    analysis_prompt = PromptTemplate(
-                        template=analysis_prompt_template,
-                        input_variables=["name", "context"]
-                    )
-
-                    # Prepare chain
-                    analysis_chain = load_qa_chain(
-                        OpenAI(temperature=0.3, max_tokens=3000),
-                        chain_type="stuff",
-                        prompt=analysis_prompt
-                    )
-
-                    # Run the chain
-                    result = analysis_chain({
-                        "input_documents": [chunk[0] for chunk in relevant_chunks],
-                        "context": context,
-                        "name": input_name
-                    })
-
-                    # Display the retrieved context and the generated analysis
+                # Well-known names are served from the precomputed profiles (lotr_profiles.py),
+                # which cover every book
+                stored = None if books else engine.get_stored_analysis(input_name, explore_type)
+                if stored:
+                    analysis, context = stored
                     st.subheader(f"Analysis of {explore_type}: {input_name}")
-                    st.write(result["output_text"])
+                    st.write(analysis)
 
                     with st.expander("Retrieved Context"):
                         st.write(context)
+                else:
+                    # Retrieve relevant text using FAISS
+                    documents, context = engine.get_explore_context(input_name, books)
+
+                    if not documents:
+                        st.warning(f"No information found for {input_name}. Try another name.")
+                    else:
+                        # Run the chain, streaming the analysis as it is generated
+                        st.subheader(f"Analysis of {explore_type}: {input_name}")
+                        analysis_placeholder = st.empty()
+                        analysis = engine.get_explore_analysis(
+                            input_name, explore_type, documents, context, callbacks=stream_into(analysis_placeholder)
+                        )
+
+                        # Display the retrieved context and the generated analysis
+                        analysis_placeholder.write(analysis)
+
+                        with st.expander("Retrieved Context"):
+                            st.write(context)
@@ -0,0 +1,104 @@
+# Context assembly shared by all chains: merge overlapping chunks, drop near-duplicates
+# and pack the most relevant text into a fixed token budget per prompt
+from langchain_core.documents import Document
+from lotr_metrics import count_tokens
+import re
+
+# Token budget for the context of each prompt. The model (gpt-3.5-turbo-instruct)
+# has a 4096 token window shared by the template, the context and the completion;
+# explore requests a completion of up to 3000 tokens, so its context stays small.
+CONTEXT_TOKEN_BUDGETS = {
+    "character": 2500,
+    "expert": 1500,
+    "explore": 600,
+    "quiz": 400,
+}
+MAX_GAP = 2  # chunks this close on the same page are adjacent (the splitter strips whitespace)
+DUPLICATE_SIMILARITY = 0.8  # word-trigram Jaccard similarity above which a passage is a duplicate
+MIN_PARTIAL_TOKENS = 50  # smallest sentence-trimmed passage worth adding to fill the budget
+DOCUMENT_SEPARATOR = "\n\n"  # what the "stuff" chains put between documents
+
+
+# Merge chunks from the same page that overlap or touch into single passages.
+# Each passage keeps the best (lowest) rank of the chunks it was built from.
+def merge_chunks(documents):
+    passages = []
+    groups = {}
+    for rank, doc in enumerate(documents):
+        if "start_index" not in doc.metadata:
+            passages.append((rank, doc))
+            continue
+        groups.setdefault((doc.metadata.get("source"), doc.metadata.get("page")), []).append((rank, doc))
+
+    for chunks in groups.values():
+        chunks.sort(key=lambda item: item[1].metadata["start_index"])
+        rank, first = chunks[0]
+        start, text, metadata = first.metadata["start_index"], first.page_content, dict(first.metadata)
+        for next_rank, doc in chunks[1:]:
+            next_start = doc.metadata["start_index"]
+            end = start + len(text)
+            if next_start > end + MAX_GAP:
+                passages.append((rank, Document(page_content=text, metadata=metadata)))
+                rank, start, text, metadata = next_rank, next_start, doc.page_content, dict(doc.metadata)
+                continue
+            # Keep only the part of the next chunk that is not already in the passage
+            new_text = doc.page_content[max(0, end - next_start):]
+            if new_text:
+                text += (" " if next_start > end else "") + new_text
+            rank = min(rank, next_rank)
+            metadata["characters"] = sorted(set(metadata.get("characters", [])) | set(doc.metadata.get("characters", [])))
+        passages.append((rank, Document(page_content=text, metadata=metadata)))
+
+    passages.sort(key=lambda item: item[0])
+    return [doc for _, doc in passages]
+
+
+def shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+
+# Drop passages whose text (mostly) repeats a more relevant passage
+def drop_duplicates(passages):
+    kept = []
+    for doc in passages:
+        words = shingles(doc.page_content)
+        if all(len(words & other) / (len(words | other) or 1) < DUPLICATE_SIMILARITY for _, other in kept):
+            kept.append((doc, words))
+    return [doc for doc, _ in kept]
+
+
+# Cut text to at most max_tokens, ending on a sentence boundary when there is one
+def trim_to_tokens(text, max_tokens):
+    sentences = re.split(r"(?<=[.!?])\s+", text)
+    trimmed = ""
+    for sentence in sentences:
+        candidate = f"{trimmed} {sentence}".strip()
+        if count_tokens(candidate) > max_tokens:
+            break
+        trimmed = candidate
+    return trimmed
+
+
+# Build the context for a prompt from retrieved documents, most relevant first.
+# Returns the packed documents (to pass as input_documents) and the context text
+# exactly as the chain will put it into the prompt.
+def pack_context(documents, kind):
+    budget = CONTEXT_TOKEN_BUDGETS[kind]
+    separator_tokens = count_tokens(DOCUMENT_SEPARATOR)
+    packed = []
+    used = 0
+    for doc in drop_duplicates(merge_chunks(documents)):
+        cost = count_tokens(doc.page_content) + (separator_tokens if packed else 0)
+        if used + cost <= budget:
+            packed.append(doc)
+            used += cost
+            continue
+        # Fill the rest of the budget with the leading sentences of the passage
+        remaining = budget - used - (separator_tokens if packed else 0)
+        if remaining >= MIN_PARTIAL_TOKENS:
+            text = trim_to_tokens(doc.page_content, remaining)
+            if text:
+                packed.append(Document(page_content=text, metadata=doc.metadata))
+                used += count_tokens(text) + (separator_tokens if len(packed) > 1 else 0)
+    return packed, DOCUMENT_SEPARATOR.join(doc.page_content for doc in packed)
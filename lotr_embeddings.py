@@ -0,0 +1,226 @@
+# Embedding backends (OpenAI or local, CPU-only models) and the persistent, batched
+# embedding cache shared by index builds
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, OrderedDict
+from langchain_core.embeddings import Embeddings
+from lotr_lexical import tokenize
+import numpy as np
+import hashlib
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite"
+EMBED_BATCH_SIZE = 256
+EMBED_MAX_WORKERS = 4
+EMBED_MAX_RETRIES = 5
+EMBED_BACKOFF_SECONDS = 1.0
+QUERY_CACHE_SIZE = 1024  # recent query vectors kept in memory (never written to disk)
+# SQLite limits the number of "?" parameters in a single statement
+SQLITE_MAX_PARAMS = 900
+
+# Backend used for the index and queries; the manifest records it, so switching rebuilds the index
+EMBEDDING_BACKEND = os.environ.get("LOTR_EMBEDDING_BACKEND", "openai")
+LOCAL_EMBEDDING_MODEL = os.environ.get("LOTR_LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# LangChain counts tokens with tiktoken (its encoding is downloaded on first use) to split
+# texts longer than the model's context; 0 sends texts as they are, e.g. offline to a stand-in
+OPENAI_CHECK_CTX_LENGTH = os.environ.get("LOTR_OPENAI_CHECK_CTX_LENGTH", "1") != "0"
+OPENAI_EMBEDDING_MODEL = "text-embedding-ada-002"
+LOCAL_BATCH_SIZE = 64
+HASHING_DIMENSION = 1024
+HASHING_WORKERS = os.cpu_count() or 1
+HASHING_PROCESS_MIN_TEXTS = 128  # smaller batches are hashed in the calling thread
+
+
+# Wraps another embedding model and stores every document vector on disk, keyed by a
+# hash of the model name and the text. Only cache misses are sent to the wrapped model,
+# in size-limited batches with bounded concurrency and exponential backoff. Query
+# vectors are only kept in a bounded in-memory LRU, so visitors' questions do not
+# grow the file or commit to it in the request path.
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, path=EMBEDDING_CACHE_PATH, batch_size=EMBED_BATCH_SIZE,
+                 max_workers=EMBED_MAX_WORKERS, max_retries=EMBED_MAX_RETRIES, backend="custom", query_cache_size=QUERY_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.backend = backend
+        self.query_cache_size = query_cache_size
+        self.queries = OrderedDict()
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    # The manifest records the wrapped model, not the cache
+    @property
+    def model(self):
+        return self.embeddings.model
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+                batch = keys[start:start + SQLITE_MAX_PARAMS]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+        return found
+
+    def _store(self, items):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vector.tobytes()) for key, vector in items],
+            )
+            self._conn.commit()
+
+    # Retry a single batch with exponential backoff and jitter (rate limits, timeouts)
+    def _embed_batch(self, texts):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.embeddings.embed_documents(texts)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(EMBED_BACKOFF_SECONDS * 2 ** attempt + random.uniform(0, EMBED_BACKOFF_SECONDS))
+
+    def embed_documents(self, texts):
+        keys = [self.key(text) for text in texts]
+        vectors = self._lookup(list(set(keys)))
+
+        # Embed each missing text once, even if it appears several times
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+
+        if missing:
+            missing_keys = list(missing)
+            batches = [missing_keys[i:i + self.batch_size] for i in range(0, len(missing_keys), self.batch_size)]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                # Results are stored as each batch finishes so an interrupted build keeps its progress
+                for batch, embedded in zip(batches, pool.map(lambda b: self._embed_batch([missing[k] for k in b]), batches)):
+                    items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in zip(batch, embedded)]
+                    self._store(items)
+                    vectors.update(items)
+
+        # Cached and freshly embedded vectors go through the same float32 round trip
+        return [vectors[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        with self._lock:
+            vector = self.queries.get(text)
+            if vector is not None:
+                self.queries.move_to_end(text)
+        if vector is None:
+            vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+            with self._lock:
+                self.queries[text] = vector
+                while len(self.queries) > self.query_cache_size:
+                    self.queries.popitem(last=False)
+        return vector.tolist()
+
+
+def openai_embeddings():
+    from langchain_openai import OpenAIEmbeddings
+    from lotr_pipeline import openai_clients
+    sync_client, async_client = openai_clients()
+    if not OPENAI_CHECK_CTX_LENGTH:
+        return DirectOpenAIEmbeddings(sync_client.embeddings)
+    return OpenAIEmbeddings(model=OPENAI_EMBEDDING_MODEL, client=sync_client.embeddings, async_client=async_client.embeddings)
+
+
+# OpenAI embeddings without token counting: the texts go to the endpoint as they are,
+# which is fine for the index chunks and queries (far below the model's context)
+class DirectOpenAIEmbeddings(Embeddings):
+    def __init__(self, client, model=OPENAI_EMBEDDING_MODEL):
+        self.client = client
+        self.model = model
+
+    def embed_documents(self, texts):
+        response = self.client.create(input=texts, model=self.model)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# Local sentence-transformers model on the CPU (pip install sentence-transformers).
+# LOCAL_EMBEDDING_MODEL may be a model name, downloaded once, or a local directory.
+class SentenceTransformerEmbeddings(Embeddings):
+    def __init__(self, model_name=LOCAL_EMBEDDING_MODEL, batch_size=LOCAL_BATCH_SIZE):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("The local embedding backend needs sentence-transformers: pip install sentence-transformers")
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.encoder = SentenceTransformer(model_name, device="cpu")
+
+    @property
+    def model(self):
+        return f"local:{self.model_name}"
+
+    def embed_documents(self, texts):
+        return self.encoder.encode(texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# Signed feature hashing of words and word pairs with sublinear term frequency
+def hash_features(text, dimension=HASHING_DIMENSION):
+    words = tokenize(text)
+    vector = np.zeros(dimension, dtype=np.float32)
+    for feature, count in Counter(words + [f"{a} {b}" for a, b in zip(words, words[1:])]).items():
+        digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+        vector[digest % dimension] += (1.0 if digest >> 63 else -1.0) * (1.0 + math.log(count))
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+# Dependency-free local embeddings: no model files and no network, a query takes well
+# under a millisecond. Matches shared words and phrases rather than meaning, so the
+# sentence-transformers backend retrieves better when it can be installed.
+class HashingEmbeddings(Embeddings):
+    def __init__(self, dimension=HASHING_DIMENSION, workers=HASHING_WORKERS):
+        self.dimension = dimension
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    @property
+    def model(self):
+        return f"hashing-{self.dimension}"
+
+    def embed_documents(self, texts):
+        if len(texts) < HASHING_PROCESS_MIN_TEXTS or self.workers < 2:
+            return [hash_features(text, self.dimension).tolist() for text in texts]
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        dimensions = [self.dimension] * len(texts)
+        return [vector.tolist() for vector in self.pool.map(hash_features, texts, dimensions, chunksize=32)]
+
+    def embed_query(self, text):
+        return hash_features(text, self.dimension).tolist()
+
+
+EMBEDDING_BACKENDS = {
+    "openai": openai_embeddings,
+    "local": SentenceTransformerEmbeddings,
+    "hashing": HashingEmbeddings,
+}
+
+
+# The configured backend behind the on-disk cache
+def create_embeddings(backend=EMBEDDING_BACKEND):
+    return CachedEmbeddings(EMBEDDING_BACKENDS[backend](), backend=backend)
@@ -0,0 +1,457 @@
+# Build, load and incrementally update the FAISS indexes over the books in docs/,
+# one shard per book (see lotr_shards for searching across them)
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from langchain_core.documents import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+from lotr_embeddings import EMBEDDING_BACKEND, EMBEDDING_BACKENDS, create_embeddings
+from lotr_lexical import LexicalIndex
+from dotenv import load_dotenv
+import numpy as np
+import argparse
+import faiss
+import hashlib
+import itertools
+import json
+import glob
+import os
+import pickle
+import pypdf
+import re
+import shutil
+
+# Index settings (changing any of these invalidates the saved index)
+DOCS_DIR = "docs"
+INDEX_DIR = "lotr_faiss_index"
+SHARDS_DIR = os.path.join(INDEX_DIR, "shards")  # one index directory per book
+MANIFEST_FILE = "manifest.json"
+CHARACTER_INDEX_FILE = "characters.json"
+LEXICAL_INDEX_FILE = "lexical.json"
+MANIFEST_VERSION = 7
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+
+# Characters to tag chunks with, and the other names they go by in the books
+CHARACTER_ALIASES = {
+    "Frodo": ["Frodo", "Mr. Underhill"],
+    "Gandalf": ["Gandalf", "Mithrandir", "Olórin", "Incánus", "Tharkûn", "Stormcrow", "Grey Pilgrim"],
+    "Aragorn": ["Aragorn", "Strider", "Elessar", "Elfstone", "Estel", "Thorongil", "Isildur's Heir"],
+    "Galadriel": ["Galadriel", "Lady of Lórien", "Lady of the Galadhrim", "Lady of the Golden Wood"],
+    "Tom Bombadil": ["Tom Bombadil", "Bombadil", "Iarwain Ben-adar"],
+    "Gollum": ["Gollum", "Sméagol", "Smeagol"],
+    "Sauron": ["Sauron", "Dark Lord", "Lord of Mordor", "Lidless Eye", "Lord of Barad-dûr"],
+    "Saruman": ["Saruman", "Sharkey", "Curunír"],
+}
+
+# Ingestion settings (these do not change the index contents)
+INGEST_WORKERS = os.cpu_count() or 1
+PAGES_PER_TASK = 25
+INDEX_BATCH_SIZE = 512
+
+# Serving settings: the flat index stays the source of truth for updates, and with a
+# compression other than "flat" a quantized copy of its vectors is saved next to it
+# and opened read-only and memory-mapped, so replicas on one host share page cache
+INDEX_COMPRESSION = os.environ.get("LOTR_INDEX_COMPRESSION", "flat")
+COMPRESSIONS = {
+    "flat": None,
+    "fp16": "SQfp16",  # 2 bytes per dimension
+    "sq8": "SQ8",  # 1 byte per dimension
+    "ivfpq": "IVF{lists},PQ{subquantizers}x{bits}",  # up to 1 byte per 16 dimensions, approximate search
+}
+IVF_NPROBE = 16  # inverted lists visited per IVF search
+RECALL_K = 10
+RECALL_QUERIES = 200
+
+# Chunks embedded by earlier builds are served from the on-disk cache
+def get_embeddings(backend=EMBEDDING_BACKEND):
+    return create_embeddings(backend)
+
+# Hash file contents so renamed or touched PDFs do not trigger a rebuild
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+# Everything besides the PDFs themselves that the saved index depends on
+def build_settings(embeddings):
+    return {
+        "version": MANIFEST_VERSION,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "embedding_backend": getattr(embeddings, "backend", "custom"),
+        "embedding_model": embeddings.model,
+        "characters": CHARACTER_ALIASES,
+    }
+
+def list_books():
+    return [os.path.basename(path) for path in sorted(glob.glob(os.path.join(DOCS_DIR, "*.pdf")))]
+
+# Content hashes of the books in docs/ (optionally only the named ones)
+def scan_sources(names=None):
+    return {name: hash_file(os.path.join(DOCS_DIR, name)) for name in list_books() if names is None or name in names}
+
+# Directory of a book's shard: the same files as a whole index, over that book only
+def shard_dir(book, shards_dir=SHARDS_DIR):
+    return os.path.join(shards_dir, re.sub(r"[^\w.-]+", "_", os.path.splitext(book)[0]))
+
+# Delete the shards of books that are no longer in docs/
+def remove_stale_shards(books, shards_dir=SHARDS_DIR):
+    keep = {os.path.basename(shard_dir(book, shards_dir)) for book in books}
+    removed = []
+    if os.path.isdir(shards_dir):
+        for name in sorted(os.listdir(shards_dir)):
+            if name not in keep and os.path.isdir(os.path.join(shards_dir, name)):
+                shutil.rmtree(os.path.join(shards_dir, name))
+                removed.append(name)
+    return removed
+
+def read_manifest(index_dir=INDEX_DIR):
+    try:
+        with open(os.path.join(index_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Write the manifest last (and atomically) so an interrupted save forces a rebuild
+def write_manifest(manifest, index_dir=INDEX_DIR):
+    path = os.path.join(index_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+# Heuristically tag metadata (e.g., look for mentions of characters)
+def compile_tagger(aliases):
+    canonical = {alias: name for name, names in aliases.items() for alias in names}
+    # Longest aliases first so "Tom Bombadil" wins over "Bombadil"
+    pattern = "|".join(re.escape(alias) for alias in sorted(canonical, key=len, reverse=True))
+    return re.compile(rf"\b(?:{pattern})(?!\w)"), canonical
+
+CHARACTER_PATTERN, CHARACTER_BY_ALIAS = compile_tagger(CHARACTER_ALIASES)
+
+# Tag a chunk with every character it mentions by any alias, in a single scan
+def tag_characters(text):
+    found = {CHARACTER_BY_ALIAS[match.group()] for match in CHARACTER_PATTERN.finditer(text)}
+    return [name for name in CHARACTER_ALIASES if name in found]
+
+# Inverted index: character -> ids of the chunks tagged with them
+def build_character_index(index):
+    character_index = {name: [] for name in CHARACTER_ALIASES}
+    for chunk_id in index.index_to_docstore_id.values():
+        for name in index.docstore.search(chunk_id).metadata.get("characters", []):
+            character_index[name].append(chunk_id)
+    return character_index
+
+def load_character_index(index_dir=INDEX_DIR):
+    with open(os.path.join(index_dir, CHARACTER_INDEX_FILE)) as f:
+        return json.load(f)
+
+# Positions of each character's chunks in the FAISS index, for filtered search
+def character_positions(index, character_index):
+    position = {chunk_id: i for i, chunk_id in index.index_to_docstore_id.items()}
+    return {name: np.array([position[chunk_id] for chunk_id in ids], dtype=np.int64) for name, ids in character_index.items()}
+
+# Top k (position, distance) pairs, optionally among the given index positions only.
+# The id selector makes FAISS skip every other vector, so all k results match
+# instead of being filtered later.
+def vector_search(index, query_embedding, k=4, positions=None):
+    embedding = np.array([query_embedding], dtype=np.float32)
+    if positions is None:
+        scores, found = index.index.search(embedding, min(k, index.index.ntotal))
+    else:
+        selector = faiss.IDSelectorBatch(positions)
+        if isinstance(index.index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=index.index.nprobe)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        scores, found = index.index.search(embedding, min(k, len(positions)), params=params)
+    return [(int(i), float(score)) for i, score in zip(found[0], scores[0]) if i != -1]
+
+def chunks_at(index, results):
+    return [(index.docstore.search(index.index_to_docstore_id[i]), score) for i, score in results]
+
+# Inverted term index over every chunk, numbered by FAISS position
+def build_lexical_index(index):
+    return LexicalIndex.build(
+        index.docstore.search(index.index_to_docstore_id[i]).page_content for i in range(index.index.ntotal)
+    )
+
+def load_lexical_index(index_dir=INDEX_DIR):
+    return LexicalIndex.load(os.path.join(index_dir, LEXICAL_INDEX_FILE))
+
+# Parse, split and tag one page range of a book (runs in a worker process).
+# Pages are split one at a time, like PyPDFLoader + split_documents did, and
+# chunk ids are "<file name>:<page>:<chunk number>"
+def split_pages(name, start, stop):
+    path = os.path.join(DOCS_DIR, name)
+    reader = pypdf.PdfReader(path)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, length_function=len, add_start_index=True)
+    texts = []
+    for page_number in range(start, stop):
+        page = Document(page_content=reader.pages[page_number].extract_text(), metadata={"source": path, "page": page_number})
+        for i, chunk in enumerate(text_splitter.split_documents([page])):
+            chunk.metadata["characters"] = tag_characters(chunk.page_content)
+            texts.append((f"{name}:{page_number}:{i}", chunk))
+    return texts
+
+# Page ranges of every book, produced lazily
+def page_tasks(names):
+    for name in names:
+        page_count = len(pypdf.PdfReader(os.path.join(DOCS_DIR, name)).pages)
+        for start in range(0, page_count, PAGES_PER_TASK):
+            yield name, start, min(start + PAGES_PER_TASK, page_count)
+
+# Stream (book, chunk id, chunk) in document order while a process pool parses
+# ahead. Only a small window of page ranges is in flight, which bounds memory.
+def iter_chunks(names):
+    tasks = page_tasks(names)
+    with ProcessPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        pending = deque((task[0], pool.submit(split_pages, *task)) for task in itertools.islice(tasks, INGEST_WORKERS * 2))
+        while pending:
+            name, future = pending.popleft()
+            task = next(tasks, None)
+            if task is not None:
+                pending.append((task[0], pool.submit(split_pages, *task)))
+            for chunk_id, chunk in future.result():
+                yield name, chunk_id, chunk
+
+def add_batch(index, embeddings, batch):
+    ids = [chunk_id for chunk_id, _ in batch]
+    texts = [chunk for _, chunk in batch]
+    if index is None:
+        return FAISS.from_documents(texts, embeddings, ids=ids)
+    index.add_documents(texts, ids=ids)
+    return index
+
+# Embed and add chunks as they are produced, recording their ids per book
+def index_sources(index, embeddings, names, sources):
+    batch = []
+    for name, chunk_id, chunk in iter_chunks(names):
+        sources[name]["ids"].append(chunk_id)
+        batch.append((chunk_id, chunk))
+        if len(batch) >= INDEX_BATCH_SIZE:
+            index = add_batch(index, embeddings, batch)
+            batch = []
+    if batch:
+        index = add_batch(index, embeddings, batch)
+    return index
+
+def compressed_index_path(compression, index_dir=INDEX_DIR):
+    return os.path.join(index_dir, f"index.{compression}.faiss")
+
+# Bits per PQ code for ntotal vectors: PQ needs a training point per centroid
+def pq_bits(ntotal):
+    return max(1, min(8, int(np.log2(max(ntotal, 1)))))
+
+# The compression a shard of ntotal vectors can actually use: none without vectors,
+# and sq8 instead of ivfpq with fewer vectors than PQ centroids (e.g. a one-chunk book)
+def usable_compression(compression, ntotal):
+    if ntotal == 0:
+        return "flat"
+    if compression == "ivfpq" and ntotal < 2 ** pq_bits(ntotal):
+        return "sq8"
+    return compression
+
+# Quantized copy of the vectors of a flat FAISS index (see usable_compression)
+def compress_index(flat, compression):
+    compression = usable_compression(compression, flat.ntotal)
+    if compression == "flat":
+        return flat
+    vectors = flat.reconstruct_n(0, flat.ntotal)
+    dimension = flat.d
+    lists = max(1, min(int(4 * np.sqrt(flat.ntotal)), flat.ntotal // 39))
+    bits = pq_bits(flat.ntotal)
+    # PQ splits a vector into equal parts: as many as divide it, up to one per 16 dimensions
+    subquantizers = max(m for m in range(1, max(1, dimension // 16) + 1) if dimension % m == 0)
+    factory = COMPRESSIONS[compression].format(lists=lists, subquantizers=subquantizers, bits=bits)
+    compressed = faiss.index_factory(dimension, factory, flat.metric_type)
+    compressed.train(vectors)
+    compressed.add(vectors)
+    if isinstance(compressed, faiss.IndexIVF):
+        compressed.nprobe = IVF_NPROBE
+    return compressed
+
+# Share of the flat index's top k neighbours that the compressed index also returns,
+# using a sample of the indexed vectors (minus themselves) as queries
+def recall_at_k(flat, compressed, k=RECALL_K, queries=RECALL_QUERIES):
+    sample = np.random.default_rng(0).choice(flat.ntotal, size=min(queries, flat.ntotal), replace=False)
+    vectors = flat.reconstruct_batch(sample)
+    _, expected = flat.search(vectors, k + 1)
+    _, found = compressed.search(vectors, k + 1)
+    hits = total = 0
+    for query, exact, approximate in zip(sample, expected, found):
+        exact = [i for i in exact if i not in (query, -1)][:k]
+        approximate = {i for i in approximate if i not in (query, -1)}
+        hits += len(approximate.intersection(exact))
+        total += len(exact)
+    return hits / total if total else 1.0
+
+# Write the compressed copy (atomically) and describe it for the manifest
+def save_compressed_index(index, compression, index_dir=INDEX_DIR):
+    requested, compression = compression, usable_compression(compression, index.index.ntotal)
+    if compression == "flat":
+        return {"type": "flat", "requested": requested}
+    compressed = compress_index(index.index, compression)
+    path = compressed_index_path(compression, index_dir)
+    faiss.write_index(compressed, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return {
+        "type": compression,
+        "requested": requested,
+        "bytes": os.path.getsize(path),
+        "flat_bytes": os.path.getsize(os.path.join(index_dir, "index.faiss")),
+        f"recall_at_{RECALL_K}": round(recall_at_k(index.index, compressed), 4),
+    }
+
+# The saved docstore with the compressed vectors opened read-only and memory-mapped
+def load_compressed_index(embeddings, compression, index_dir=INDEX_DIR):
+    # IVF inverted lists and flat code arrays are mapped with different flags
+    flags = faiss.IO_FLAG_MMAP if COMPRESSIONS[compression].startswith("IVF") else faiss.IO_FLAG_MMAP_IFC
+    vectors = faiss.read_index(compressed_index_path(compression, index_dir), flags | faiss.IO_FLAG_READ_ONLY)
+    with open(os.path.join(index_dir, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, vectors, docstore, index_to_docstore_id)
+
+def save_index(index, manifest, index_dir=INDEX_DIR):
+    index.save_local(index_dir)
+    with open(os.path.join(index_dir, CHARACTER_INDEX_FILE), "w") as f:
+        json.dump(build_character_index(index), f)
+    build_lexical_index(index).save(os.path.join(index_dir, LEXICAL_INDEX_FILE))
+    if INDEX_COMPRESSION != "flat":
+        manifest["compression"] = save_compressed_index(index, INDEX_COMPRESSION, index_dir)
+    else:
+        manifest.pop("compression", None)
+    write_manifest(manifest, index_dir)
+
+# Full rebuild: split and embed every chunk once (of the named books only, for a shard)
+def build_index(embeddings, index_dir=INDEX_DIR, names=None):
+    sources = scan_sources(names)
+    manifest = {
+        "settings": build_settings(embeddings),
+        "sources": {name: {"hash": file_hash, "ids": []} for name, file_hash in sources.items()},
+    }
+    index = index_sources(None, embeddings, list(sources), manifest["sources"])
+    if index is None:
+        if not names:
+            raise ValueError(f"No text found in the PDFs in {DOCS_DIR}/")
+        # A book without extractable text (e.g. scanned maps) is an empty shard: only
+        # its manifest is saved, so it is not parsed again until the book changes
+        write_manifest(manifest, index_dir)
+        return None
+    save_index(index, manifest, index_dir)
+    return index
+
+# Whether the manifest is of an empty shard (its books had no text)
+def is_empty(manifest):
+    return not any(source["ids"] for source in manifest["sources"].values())
+
+# Books in docs/ that are new or changed (added) and indexed books that are gone or changed (removed)
+def source_changes(manifest, names=None):
+    current = scan_sources(names)
+    indexed = manifest["sources"]
+    removed = [name for name in indexed if current.get(name) != indexed[name]["hash"]]
+    added = [name for name in current if name not in indexed or indexed[name]["hash"] != current[name]]
+    return current, added, removed
+
+# Bring a loaded index in line with docs/: drop the chunks of removed or changed
+# books and add the chunks of new or changed ones, then save in place
+def update_index(index, manifest, embeddings, index_dir=INDEX_DIR, names=None):
+    current, added, removed = source_changes(manifest, names)
+    indexed = manifest["sources"]
+    if not removed and not added:
+        return {"added": [], "removed": []}
+
+    stale_ids = [chunk_id for name in removed for chunk_id in indexed.pop(name)["ids"]]
+    if stale_ids:
+        index.delete(stale_ids)
+    for name in added:
+        indexed[name] = {"hash": current[name], "ids": []}
+    index_sources(index, embeddings, added, indexed)
+
+    save_index(index, manifest, index_dir)
+    return {"added": added, "removed": removed}
+
+# Compression the manifest's saved copy was made for (LOTR_INDEX_COMPRESSION at the
+# time) and the one actually used, which differs for shards too small to compress
+def saved_compressions(manifest):
+    compression = manifest.get("compression", {})
+    return compression.get("requested", compression.get("type", "flat")), compression.get("type", "flat")
+
+# The flat index, or the compressed copy recorded in the shard's manifest
+def serving_index(index, embeddings, index_dir=INDEX_DIR):
+    _, compression = saved_compressions(read_manifest(index_dir))
+    if compression == "flat":
+        return index if index is not None else FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+    return load_compressed_index(embeddings, compression, index_dir)
+
+# Load the saved index, updating it for changed books, or rebuild it from scratch
+# when there is none or it was built with different settings. With compression, the
+# flat index is only read when it has to be updated or compressed again.
+# A shard passes its own directory and book; None for an empty shard.
+def load_index(embeddings, index_dir=INDEX_DIR, names=None):
+    manifest = read_manifest(index_dir)
+    if manifest is None or manifest.get("settings") != build_settings(embeddings) or (is_empty(manifest) and any(source_changes(manifest, names)[1:])):
+        index = build_index(embeddings, index_dir, names)
+        if index is None:
+            return None
+    elif is_empty(manifest):
+        return None
+    else:
+        saved_compression, _ = saved_compressions(manifest)
+        if INDEX_COMPRESSION != "flat" and saved_compression == INDEX_COMPRESSION and not any(source_changes(manifest, names)[1:]):
+            return serving_index(None, embeddings, index_dir)
+        index = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+        changes = update_index(index, manifest, embeddings, index_dir, names)
+        # update_index only saves (and compresses) when books changed
+        if not changes["added"] and not changes["removed"] and saved_compression != INDEX_COMPRESSION:
+            save_index(index, manifest, index_dir)
+
+    if INDEX_COMPRESSION == "flat":
+        return index
+    return serving_index(index, embeddings, index_dir)
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Update the LOTR Companion FAISS index shards after adding, removing or changing books in docs/.")
+    parser.add_argument("--book", action="append", help="only update (or with --rebuild, rebuild) this book's shard; can be repeated")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the shards instead of updating them")
+    parser.add_argument("--embeddings", choices=list(EMBEDDING_BACKENDS), default=EMBEDDING_BACKEND, help="embedding backend (default: LOTR_EMBEDDING_BACKEND or openai)")
+    parser.add_argument("--compression", choices=list(COMPRESSIONS), default=INDEX_COMPRESSION, help="quantized copy of the vectors to serve from (default: LOTR_INDEX_COMPRESSION or flat)")
+    args = parser.parse_args()
+    INDEX_COMPRESSION = args.compression
+
+    books = list_books()
+    unknown = set(args.book or []) - set(books)
+    if unknown:
+        parser.error(f"not in {DOCS_DIR}/: {', '.join(sorted(unknown))}")
+    if not args.book:
+        for name in remove_stale_shards(books):
+            print(f"Removed the shard of {name}")
+
+    embeddings = get_embeddings(args.embeddings)
+    for book in args.book or books:
+        path = shard_dir(book)
+        manifest = read_manifest(path)
+        if args.rebuild or manifest is None or manifest.get("settings") != build_settings(embeddings) or is_empty(manifest):
+            index = build_index(embeddings, path, [book])
+            if index is None:
+                print(f"{book}: no text found, the shard is empty.")
+                continue
+            print(f"{book}: rebuilt with {index.index.ntotal} chunks.")
+        else:
+            index = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+            changes = update_index(index, manifest, embeddings, path, [book])
+            if not changes["added"] and saved_compressions(manifest)[0] != INDEX_COMPRESSION:
+                save_index(index, manifest, path)
+            print(f"{book}: {'updated' if changes['added'] else 'up to date'}, {index.index.ntotal} chunks.")
+
+        report = read_manifest(path).get("compression")
+        if report and report["type"] != report.get("requested", report["type"]):
+            print(f"  Too few chunks for {report['requested']}, serving {report['type']}")
+        if report and report["type"] != "flat":
+            print(
+                f"  Compressed ({report['type']}): {report['bytes'] / 2**20:.1f} MB instead of {report['flat_bytes'] / 2**20:.1f} MB, "
+                f"recall@{RECALL_K} against the flat index {report[f'recall_at_{RECALL_K}']:.3f}"
+            )
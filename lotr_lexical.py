@@ -0,0 +1,105 @@
+# Local BM25 index over the same chunks as the FAISS index, for exact-term matching
+# (proper nouns such as Glamdring or Andúril) without an embedding call, and rank
+# fusion of lexical and vector results
+import numpy as np
+import json
+import re
+import unicodedata
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60  # rank constant of reciprocal rank fusion
+ENTITY_QUERY_MAX_TERMS = 3  # queries this short (without stopwords) are treated as name lookups
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "by", "did", "do", "does", "for", "from", "has", "have", "he", "her",
+    "his", "how", "in", "is", "it", "its", "of", "on", "or", "she", "that", "the", "their", "they", "this",
+    "to", "was", "were", "what", "when", "where", "which", "who", "whom", "why", "with",
+}
+
+
+# Lowercased words without accents ("Andúril" matches "Anduril"), stopwords dropped
+def tokenize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [word for word in re.findall(r"\w+", text) if word not in STOPWORDS]
+
+
+# A bare name or short noun phrase rather than a question
+def is_entity_query(query):
+    return "?" not in query and 0 < len(tokenize(query)) <= ENTITY_QUERY_MAX_TERMS
+
+
+class LexicalIndex:
+    # Document numbers are the chunks' positions in the FAISS index
+    def __init__(self, lengths, postings):
+        self.lengths = np.asarray(lengths, dtype=np.float32)
+        self.average_length = float(self.lengths.mean()) if len(self.lengths) else 0.0
+        self.postings = {
+            term: (np.asarray(docs, dtype=np.int64), np.asarray(counts, dtype=np.float32))
+            for term, (docs, counts) in postings.items()
+        }
+
+    @classmethod
+    def build(cls, texts):
+        lengths = []
+        postings = {}
+        for doc, text in enumerate(texts):
+            terms = tokenize(text)
+            lengths.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                docs, tfs = postings.setdefault(term, ([], []))
+                docs.append(doc)
+                tfs.append(count)
+        return cls(lengths, postings)
+
+    def save(self, path):
+        data = {
+            "lengths": self.lengths.astype(int).tolist(),
+            "postings": {term: [docs.tolist(), counts.astype(int).tolist()] for term, (docs, counts) in self.postings.items()},
+        }
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["lengths"], data["postings"])
+
+    # BM25 score of every document for the query
+    def scores(self, query):
+        total = len(self.lengths)
+        scores = np.zeros(total, dtype=np.float32)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths / (self.average_length or 1.0))
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            docs, counts = self.postings[term]
+            idf = np.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * counts * (BM25_K1 + 1) / (counts + norm[docs])
+        return scores
+
+    # Top k (position, score) pairs with a non-zero score, optionally among the given positions only
+    def search(self, query, k=4, positions=None):
+        scores = self.scores(query)
+        if positions is not None:
+            candidates = np.asarray(positions, dtype=np.int64)
+            candidates = candidates[scores[candidates] > 0]
+        else:
+            candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(i), float(scores[i])) for i in ranked]
+
+
+# Merge several rankings (lists of positions, best first) into one, best first
+def reciprocal_rank_fusion(*rankings):
+    fused = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            fused[position] = fused.get(position, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,117 @@
+# Bounded conversation memory for the Interview and Expert pages: the last turns are
+# kept verbatim and older ones are folded into a rolling summary in the background,
+# so the history in a prompt stays under a fixed token budget however long the chat
+from concurrent.futures import ThreadPoolExecutor
+from lotr_context import trim_to_tokens
+from lotr_metrics import count_tokens
+import re
+import threading
+
+MEMORY_TURNS = 3  # most recent turns kept verbatim
+HISTORY_TOKEN_BUDGET = 700  # summary plus verbatim turns
+SUMMARY_TOKEN_CAP = 250
+TURN_TOKEN_CAP = 250  # longer answers are cut (at a sentence) before they are remembered
+SUMMARY_WORKERS = 2
+# Words that refer back to the conversation ("what did he do next?", "why was that?")
+FOLLOW_UP_WORDS = {
+    "he", "she", "it", "they", "him", "her", "them", "his", "hers", "its", "their", "theirs",
+    "this", "that", "these", "those", "there", "then", "next", "else", "again",
+}
+SHORT_QUESTION_WORDS = 2  # "Why?", "And then?", "What happened?"
+
+summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summary")
+
+
+# Whether a question names someone or something: a capitalised word other than the
+# first of a sentence (and "I"), e.g. "Tom Bombadil" or "the Ring"
+def names_something(question):
+    for sentence in re.split(r"[.!?]+", question):
+        if any(word[0].isupper() and word != "I" for word in re.findall(r"\w+", sentence)[1:]):
+            return True
+    return False
+
+
+# Whether a question can only be understood from the conversation: it names nothing
+# and is either very short or refers back with a pronoun ("what did he do next?").
+# "Who is Tom Bombadil and what did he do?" stands on its own.
+def is_follow_up(question):
+    if names_something(question):
+        return False
+    words = re.findall(r"\w+", question.lower())
+    return len(words) <= SHORT_QUESTION_WORDS or not FOLLOW_UP_WORDS.isdisjoint(words)
+
+
+class ConversationMemory:
+    # summarize(summary, lines) returns the summary extended with the given lines
+    def __init__(self, speaker, summarize):
+        self.speaker = speaker
+        self.summarize = summarize
+        self.lock = threading.Lock()
+        self.turns = []
+        self.pending = []  # evicted turns waiting to be folded into the summary
+        self.summary = ""
+        self.summarizing = False
+        self.generation = 0  # bumped by clear() so late summaries of old turns are dropped
+
+    def lines(self, turns):
+        return "\n".join(f"User: {question}\n{self.speaker}: {answer}" for question, answer in turns)
+
+    def add(self, question, answer):
+        with self.lock:
+            self.turns.append((question, trim_to_tokens(answer, TURN_TOKEN_CAP) or answer[:4 * TURN_TOKEN_CAP]))
+            # Evict the oldest turns beyond MEMORY_TURNS or the token budget (always keeping the last one)
+            while len(self.turns) > MEMORY_TURNS or (
+                len(self.turns) > 1 and count_tokens(self.summary) + count_tokens(self.lines(self.turns)) > HISTORY_TOKEN_BUDGET
+            ):
+                self.pending.append(self.turns.pop(0))
+            start = bool(self.pending) and not self.summarizing
+            if start:
+                self.summarizing = True
+        if start:
+            summary_executor.submit(self.fold)
+
+    # Fold the evicted turns into the summary until none are left (runs in the background)
+    def fold(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.summarizing = False
+                    return
+                summary, turns, generation = self.summary, self.pending, self.generation
+                self.pending = []
+            try:
+                summary = self.summarize(summary, self.lines(turns)).strip()
+                summary = trim_to_tokens(summary, SUMMARY_TOKEN_CAP) or summary[:4 * SUMMARY_TOKEN_CAP]
+            except Exception:
+                # Keep the previous summary; these turns are dropped rather than retried forever
+                continue
+            with self.lock:
+                if generation == self.generation:
+                    self.summary = summary
+
+    # History for the prompt: the rolling summary, then the recent turns verbatim
+    def render(self):
+        with self.lock:
+            parts = []
+            if self.summary:
+                parts.append(f"Summary of the earlier conversation: {self.summary}")
+            if self.turns:
+                parts.append(self.lines(self.turns))
+            return "\n".join(parts)
+
+    # Text to retrieve with: a follow-up ("what did he do next?") is searched together
+    # with the previous question, which usually names what it refers to. Other questions
+    # are searched as they are.
+    def search_query(self, question):
+        refers_back = is_follow_up(question)
+        with self.lock:
+            if not self.turns or not refers_back:
+                return question
+            return f"{self.turns[-1][0]}\n{question}"
+
+    def clear(self):
+        with self.lock:
+            self.turns = []
+            self.pending = []
+            self.summary = ""
+            self.generation += 1
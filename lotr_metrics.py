@@ -0,0 +1,245 @@
+# Per-stage latency, token and cache instrumentation for the engine's request paths.
+# Every request (character, expert, explore, quiz) is recorded as a trace of stage
+# timings and counts. Traces feed process-wide histograms/counters that can be read
+# as a summary, exported as Prometheus text, or logged as JSON lines.
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RECENT_TRACES = 200
+RECENT_SAMPLES = 1000
+TOKEN_MODEL = "gpt-3.5-turbo-instruct"  # default model of langchain_openai.OpenAI
+
+logger = logging.getLogger("lotr.metrics")
+
+
+@functools.lru_cache(maxsize=1)
+def token_encoding():
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(TOKEN_MODEL)
+    except Exception:  # tiktoken missing or its encoding files cannot be downloaded
+        return None
+
+
+# Exact count with tiktoken, or the usual ~4 characters per token estimate without it
+def count_tokens(text):
+    encoding = token_encoding()
+    return len(encoding.encode(text)) if encoding else len(text) // 4
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+    def percentile(self, fraction):
+        values = sorted(self.recent)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(Histogram)  # (operation, stage) -> seconds
+        self.counters = defaultdict(float)  # (name, operation) -> total
+        self.traces = deque(maxlen=RECENT_TRACES)
+
+    def record(self, trace):
+        with self.lock:
+            for stage, seconds in trace.stages.items():
+                self.latency[(trace.operation, stage)].observe(seconds)
+            self.counters[("requests", trace.operation)] += 1
+            if trace.error:
+                self.counters[("errors", trace.operation)] += 1
+            for name in ("retrieved_chunks", "prompt_tokens", "completion_tokens"):
+                self.counters[(name, trace.operation)] += trace.fields.get(name, 0)
+            if trace.fields.get("degraded"):
+                self.counters[("degraded", trace.operation)] += 1
+            if "fallback" in trace.fields:
+                self.counters[("fallbacks", trace.operation)] += 1
+            if trace.fields.get("coalesced"):
+                self.counters[("coalesced", trace.operation)] += 1
+            if "cache_hit" in trace.fields:
+                self.counters[("cache_hits" if trace.fields["cache_hit"] else "cache_misses", trace.operation)] += 1
+            self.traces.append(trace.as_dict())
+        logger.info(json.dumps(trace.as_dict()))
+
+    # Latency percentiles per operation and stage, plus counter totals
+    def summary(self):
+        with self.lock:
+            stages = [
+                {
+                    "operation": operation,
+                    "stage": stage,
+                    "count": histogram.count,
+                    "p50_ms": round(1000 * histogram.percentile(0.50), 1),
+                    "p95_ms": round(1000 * histogram.percentile(0.95), 1),
+                    "p99_ms": round(1000 * histogram.percentile(0.99), 1),
+                }
+                for (operation, stage), histogram in sorted(self.latency.items())
+            ]
+            counters = defaultdict(dict)
+            for (name, operation), value in sorted(self.counters.items()):
+                counters[operation][name] = value
+            return {"stages": stages, "counters": dict(counters), "recent": list(self.traces)}
+
+    def prometheus(self):
+        lines = [
+            "# HELP lotr_stage_seconds Latency of each request stage.",
+            "# TYPE lotr_stage_seconds histogram",
+        ]
+        with self.lock:
+            for (operation, stage), histogram in sorted(self.latency.items()):
+                labels = f'operation="{operation}",stage="{stage}"'
+                for bound, count in zip(LATENCY_BUCKETS, histogram.buckets):
+                    lines.append(f'lotr_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'lotr_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"lotr_stage_seconds_sum{{{labels}}} {histogram.total}")
+                lines.append(f"lotr_stage_seconds_count{{{labels}}} {histogram.count}")
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f"# TYPE lotr_{name}_total counter")
+                for (counter, operation), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'lotr_{name}_total{{operation="{operation}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+    def json_lines(self):
+        with self.lock:
+            return "".join(json.dumps(trace) + "\n" for trace in self.traces)
+
+
+metrics = Metrics()
+
+
+# One request: stage timings plus counts such as retrieved chunks and tokens
+class Trace:
+    def __init__(self, operation):
+        self.operation = operation
+        self.started = time.time()
+        self.stages = {}
+        self.fields = {}
+        self.error = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    # LangChain callback timing prompt assembly, the completion and time to first
+    # token, and counting prompt/completion tokens (OpenAI reports no usage when streaming)
+    def llm_callback(self):
+        from langchain_core.callbacks import BaseCallbackHandler
+        trace = self
+
+        class TraceHandler(BaseCallbackHandler):
+            run_inline = True  # time tokens as they arrive, also in async chains
+
+            def __init__(self):
+                self.chain_start = None
+                self.llm_start = None
+                self.first_token = None
+
+            def on_chain_start(self, serialized, inputs, **kwargs):
+                if self.chain_start is None:
+                    self.chain_start = time.perf_counter()
+
+            def on_llm_start(self, serialized, prompts, **kwargs):
+                self.llm_start = time.perf_counter()
+                if self.chain_start is not None:
+                    trace.stages["prompt"] = self.llm_start - self.chain_start
+                trace.set(prompt_tokens=sum(count_tokens(prompt) for prompt in prompts))
+
+            def on_llm_new_token(self, token, **kwargs):
+                if self.first_token is None:
+                    self.first_token = time.perf_counter()
+                    trace.stages["first_token"] = self.first_token - self.llm_start
+
+            def on_llm_end(self, response, **kwargs):
+                trace.stages["llm"] = time.perf_counter() - self.llm_start
+                usage = (response.llm_output or {}).get("token_usage") or {}
+                if usage.get("prompt_tokens"):
+                    trace.set(prompt_tokens=usage["prompt_tokens"])
+                completion = "".join(g.text for generations in response.generations for g in generations)
+                trace.set(completion_tokens=usage.get("completion_tokens") or count_tokens(completion))
+        return TraceHandler()
+
+    def as_dict(self):
+        return {
+            "operation": self.operation,
+            "timestamp": round(self.started, 3),
+            "total_ms": round(1000 * self.stages.get("total", 0.0), 1),
+            "stages_ms": {name: round(1000 * seconds, 1) for name, seconds in self.stages.items() if name != "total"},
+            "error": self.error,
+            **self.fields,
+        }
+
+
+# Record a request: `with trace("expert") as t: with t.stage("search"): ...`
+@contextlib.contextmanager
+def trace(operation):
+    current = Trace(operation)
+    try:
+        with current.stage("total"):
+            yield current
+    except Exception as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        metrics.record(current)
+
+
+# Append every trace as a JSON line to a file (structured logs)
+def log_to_file(path):
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return handler
+
+# Serve the Prometheus text format on http://<host>:<port>/metrics from a daemon thread.
+# The endpoint has no authentication, so it only listens on localhost unless told otherwise.
+def serve_prometheus(port, host="127.0.0.1"):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="lotr-metrics", daemon=True).start()
+    return server
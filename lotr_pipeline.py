@@ -0,0 +1,128 @@
+# Asyncio pipeline behind the engine. One event loop, in a background thread, runs the
+# stages of every request (embedding, lexical and vector search, cache lookup, chain
+# calls) so independent stages overlap and each has a timeout. The calling thread (a
+# Streamlit script) only waits for results and replays streamed tokens into its own
+# callbacks, since Streamlit elements can only be updated from their session's thread.
+# All OpenAI calls share one pooled, keep-alive client.
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import os
+import queue
+import threading
+
+# Seconds each stage may take before the request falls back (see lotr_engine)
+STAGE_TIMEOUTS = {
+    "embed_query": 10.0,
+    "lexical_search": 5.0,
+    "search": 5.0,
+    "cache_lookup": 2.0,
+    "llm": 90.0,
+}
+PIPELINE_WORKERS = 16  # threads for blocking stages (FAISS, SQLite, sync embedding calls)
+HTTP_MAX_CONNECTIONS = 50
+HTTP_KEEPALIVE_CONNECTIONS = 20
+HTTP_KEEPALIVE_SECONDS = 60.0
+HTTP_TIMEOUT_SECONDS = 120.0
+# Retries of failed OpenAI requests (rate limits, 5xx, connection errors) inside the client
+OPENAI_MAX_RETRIES = int(os.environ.get("LOTR_OPENAI_MAX_RETRIES", "2"))
+
+
+# One sync and one async OpenAI client per process, each with its own keep-alive
+# connection pool; every model in the app uses these instead of opening its own
+@functools.lru_cache(maxsize=1)
+def openai_clients():
+    import httpx
+    import openai
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+    )
+    sync_client = openai.OpenAI(max_retries=OPENAI_MAX_RETRIES, http_client=httpx.Client(limits=limits, timeout=HTTP_TIMEOUT_SECONDS))
+    async_client = openai.AsyncOpenAI(max_retries=OPENAI_MAX_RETRIES, http_client=httpx.AsyncClient(limits=limits, timeout=HTTP_TIMEOUT_SECONDS))
+    return sync_client, async_client
+
+
+class Pipeline:
+    def __init__(self, workers=PIPELINE_WORKERS):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pipeline")
+        self.loop.set_default_executor(self.executor)
+        threading.Thread(target=self.loop.run_forever, name="lotr-pipeline", daemon=True).start()
+
+    # Cancel the requests still running, then stop the loop and its thread pool
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def shutdown(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        # Waiting lets the callers' futures see the cancellation before the loop stops
+        await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.get_running_loop().stop()
+
+    # Run a coroutine on the pipeline loop and wait for its result
+    def run(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    # Run make_call(token_callback) on the loop within the "llm" timeout, passing every
+    # token it streams to callbacks in the calling thread, and return its result
+    def stream(self, make_call, callbacks=None):
+        from langchain_core.callbacks import BaseCallbackHandler
+        tokens = queue.Queue()
+        done = object()
+
+        class TokenQueue(BaseCallbackHandler):
+            run_inline = True  # keep tokens in order instead of handing them to executor threads
+
+            def on_llm_new_token(self, token, **kwargs):
+                tokens.put(token)
+
+        future = asyncio.run_coroutine_threadsafe(with_timeout("llm", make_call(TokenQueue())), self.loop)
+        future.add_done_callback(lambda _: tokens.put(done))
+        try:
+            while True:
+                token = tokens.get()
+                if token is done:
+                    break
+                for callback in callbacks or []:
+                    callback.on_llm_new_token(token)
+            return future.result()
+        except BaseException:
+            future.cancel()  # e.g. the session reran: stop generating for it
+            raise
+
+
+async def with_timeout(stage, awaitable):
+    try:
+        return await asyncio.wait_for(awaitable, STAGE_TIMEOUTS[stage])
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"{stage} took longer than {STAGE_TIMEOUTS[stage]}s")
+
+
+# Time a stage of the trace and enforce its timeout
+async def stage(t, name, awaitable):
+    with t.stage(name):
+        return await with_timeout(name, awaitable)
+
+
+# Result of a stage, or default when it fails or times out (recorded on the trace)
+async def settle(t, name, awaitable, default):
+    try:
+        return await stage(t, name, awaitable)
+    except Exception as e:
+        t.set(degraded=t.fields.get("degraded", []) + [f"{name}: {type(e).__name__}"])
+        return default
+
+
+# Run a blocking function on the pipeline's thread pool
+def in_thread(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
@@ -0,0 +1,208 @@
+# Explore analyses materialized ahead of time. A batch job (py lotr_profiles.py)
+# generates the Character and Artifact profiles of well-known names in parallel and
+# stores them with their retrieved context. The Explore page serves a stored profile
+# with a dictionary lookup and only calls the model for other names. The store is
+# tied to the index manifest and the analysis prompts: after the books, the index
+# settings or the prompts change it is ignored until the job runs again.
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lotr_lexical import tokenize
+import hashlib
+import json
+import os
+import threading
+import time
+
+PROFILE_STORE_PATH = "explore_profiles.json"
+PROFILE_STORE_VERSION = 1  # bump when retrieval or packing for Explore changes
+PROFILE_WORKERS = 8
+
+# Names materialized by default. Characters also match their aliases in
+# lotr_index.CHARACTER_ALIASES ("Mithrandir" is served Gandalf's profile).
+PROFILE_CHARACTERS = [
+    "Frodo", "Sam", "Merry", "Pippin", "Bilbo", "Gandalf", "Aragorn", "Legolas", "Gimli", "Boromir", "Faramir",
+    "Galadriel", "Elrond", "Arwen", "Tom Bombadil", "Treebeard", "Théoden", "Éowyn", "Denethor", "Gollum",
+    "Saruman", "Sauron", "the Witch-king",
+]
+ARTIFACT_ALIASES = {
+    "the One Ring": ["the Ring", "Ring of Power", "Isildur's Bane"],
+    "Sting": [],
+    "Glamdring": ["Foe-hammer"],
+    "Andúril": ["Flame of the West"],
+    "Narsil": ["the Sword that was Broken"],
+    "the Palantíri": ["Palantír", "the Seeing Stones", "the Seeing Stone"],
+    "the Phial of Galadriel": ["the Phial", "the Star-glass"],
+    "Mithril": ["mithril coat", "mithril shirt"],
+    "the Horn of Gondor": ["Boromir's horn"],
+    "Narya": [],
+    "Nenya": [],
+    "Vilya": [],
+}
+
+
+# Lookup key of a name: accents, case, spacing and words like "the" do not matter
+def profile_key(explore_type, name):
+    return f"{explore_type}:{' '.join(tokenize(name))}"
+
+
+# What a stored profile depends on: the indexed books and index settings (from the
+# manifest), the analysis prompts and the store version
+def store_fingerprint(manifest, templates):
+    payload = {
+        "version": PROFILE_STORE_VERSION,
+        "settings": manifest.get("settings"),
+        "sources": {name: source["hash"] for name, source in manifest.get("sources", {}).items()},
+        "templates": templates,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ProfileStore:
+    # aliases maps an explore type to {canonical name: [aliases]}
+    def __init__(self, fingerprint, path=PROFILE_STORE_PATH, aliases=None):
+        self.fingerprint = fingerprint
+        self.path = path
+        self.lock = threading.Lock()
+        self.aliases = {
+            profile_key(explore_type, alias): profile_key(explore_type, name)
+            for explore_type, names in (aliases or {}).items()
+            for name, name_aliases in names.items()
+            for alias in name_aliases
+        }
+        self.profiles = {}
+        self.mtime = None
+        self.refresh()
+
+    # Re-read the file when it changed on disk (e.g. the batch job ran while the app
+    # was up); a store written for another fingerprint counts as empty
+    def refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            profiles = {}
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("fingerprint") == self.fingerprint:
+                    profiles = data.get("profiles", {})
+            except (OSError, ValueError):
+                pass
+            self.profiles = profiles
+            self.mtime = mtime
+
+    # Stored {"name", "analysis", "context", "created"} for a name or one of its aliases, or None
+    def get(self, explore_type, name):
+        self.refresh()
+        key = profile_key(explore_type, name)
+        profile = self.profiles.get(key)
+        if profile is None and key in self.aliases:
+            profile = self.profiles.get(self.aliases[key])
+        return profile
+
+    def put(self, explore_type, name, analysis, context):
+        with self.lock:
+            self.profiles[profile_key(explore_type, name)] = {
+                "name": name, "analysis": analysis, "context": context, "created": time.time(),
+            }
+
+    def __len__(self):
+        return len(self.profiles)
+
+    # Written atomically, so the app never reads a half-written store
+    def save(self):
+        with self.lock:
+            data = {"version": PROFILE_STORE_VERSION, "fingerprint": self.fingerprint, "profiles": self.profiles}
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+            os.replace(self.path + ".tmp", self.path)
+            self.mtime = os.stat(self.path).st_mtime_ns
+
+
+# Generate the profiles of (explore type, name) pairs in parallel with analyze(name,
+# explore_type), which returns (analysis, context) or None when nothing was found.
+# Names already in the store are skipped unless refresh is set. The store is saved
+# after every profile, so an interrupted run keeps what it finished.
+# Returns {"generated": [...], "skipped": [...], "not_found": [...], "failed": {name: error}}.
+def materialize(store, entities, analyze, workers=PROFILE_WORKERS, refresh=False):
+    report = {"generated": [], "skipped": [], "not_found": [], "failed": {}}
+    pending = []
+    for explore_type, name in entities:
+        if not refresh and store.get(explore_type, name) is not None:
+            report["skipped"].append(f"{explore_type}: {name}")
+        else:
+            pending.append((explore_type, name))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(analyze, name, explore_type): (explore_type, name) for explore_type, name in pending}
+        for future in as_completed(futures):
+            explore_type, name = futures[future]
+            label = f"{explore_type}: {name}"
+            try:
+                result = future.result()
+            except Exception as e:
+                report["failed"][label] = f"{type(e).__name__}: {e}"
+                continue
+            if result is None:
+                report["not_found"].append(label)
+                continue
+            store.put(explore_type, name, *result)
+            store.save()
+            report["generated"].append(label)
+    return report
+
+
+# (explore type, name) pairs from a file with one "Character: Gandalf" or
+# "Artifact: Sting" per line (blank lines and # comments are ignored)
+def read_entities(path):
+    entities = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            explore_type, _, name = (part.strip() for part in line.partition(":"))
+            if explore_type not in ("Character", "Artifact") or not name:
+                raise ValueError(f"{path}:{number}: expected 'Character: <name>' or 'Artifact: <name>'")
+            entities.append((explore_type, name))
+    return entities
+
+
+if __name__ == "__main__":
+    import argparse
+    import lotr_engine
+
+    parser = argparse.ArgumentParser(description="Precompute the Explore analyses of well-known characters and artifacts.")
+    parser.add_argument("--entities", help="file with one 'Character: <name>' or 'Artifact: <name>' per line (default: built-in list)")
+    parser.add_argument("--workers", type=int, default=PROFILE_WORKERS, help="analyses generated at the same time")
+    parser.add_argument("--refresh", action="store_true", help="regenerate profiles that are already stored")
+    args = parser.parse_args()
+
+    if args.entities:
+        entities = read_entities(args.entities)
+    else:
+        entities = [("Character", name) for name in PROFILE_CHARACTERS] + [("Artifact", name) for name in ARTIFACT_ALIASES]
+
+    # The live Explore path, bypassing the store
+    def analyze(name, explore_type):
+        documents, context = lotr_engine.get_explore_context(name)
+        if not documents:
+            return None
+        analysis = lotr_engine.get_explore_analysis(name, explore_type, documents, context)
+        if analysis == lotr_engine.TIMEOUT_ANSWER:
+            raise TimeoutError("the model did not answer in time")
+        return analysis, context
+
+    store = lotr_engine.get_profile_store()
+    start = time.perf_counter()
+    report = materialize(store, entities, analyze, args.workers, args.refresh)
+    print(f"Generated {len(report['generated'])} profiles in {time.perf_counter() - start:.1f}s, "
+          f"skipped {len(report['skipped'])} already stored; {len(store)} profiles in {store.path}.")
+    for label in report["not_found"]:
+        print(f"No context found for {label}")
+    for label, error in report["failed"].items():
+        print(f"Failed {label}: {error}")
+    if report["failed"]:
+        raise SystemExit(1)
@@ -0,0 +1,198 @@
+# The index split into one shard per book (lotr_index builds and updates each one
+# on its own). Shards are loaded on first use, so a search limited to some books
+# (e.g. a spoiler-free "The Fellowship of the Ring only") never loads the others.
+# Searches fan out to the selected shards on a thread pool (FAISS releases the GIL)
+# and their results are merged into one top k. Chunk positions are (book, position
+# in the book's shard) pairs. A book without text is an empty shard, and a shard
+# that fails to load is left out of the search (and tried again next time).
+from concurrent.futures import ThreadPoolExecutor
+from lotr_index import (
+    SHARDS_DIR, character_positions, list_books, load_character_index, load_index,
+    load_lexical_index, read_manifest, remove_stale_shards, shard_dir, vector_search,
+)
+from lotr_lexical import reciprocal_rank_fusion
+import faiss
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+
+SHARD_WORKERS = 8
+
+logger = logging.getLogger("lotr.shards")
+
+# Shards are loaded (and built or updated) one at a time, so a cold start builds one
+# book after another within the ingest (INGEST_WORKERS) and embedding (EMBED_MAX_WORKERS)
+# limits instead of once per shard; only the searches fan out
+load_lock = threading.Lock()
+
+
+class Shard:
+    def __init__(self, book, embeddings, shards_dir=SHARDS_DIR):
+        self.book = book
+        self.path = shard_dir(book, shards_dir)
+        self.embeddings = embeddings
+        self.loaded = False
+        self.manifest = None
+        self.index = None
+        self.lexical_index = None
+        self.characters = None
+
+    # Load the shard, building or updating it first when its book changed
+    def load(self):
+        if not self.loaded:
+            with load_lock:
+                if not self.loaded:
+                    os.makedirs(self.path, exist_ok=True)
+                    index = load_index(self.embeddings, self.path, [self.book])
+                    if index is None:
+                        logger.warning("No text found in %s, its shard is empty", self.book)
+                    else:
+                        self.lexical_index = load_lexical_index(self.path)
+                        self.characters = character_positions(index, load_character_index(self.path))
+                    self.manifest = read_manifest(self.path)
+                    self.index = index
+                    self.loaded = True
+        return self
+
+    # Positions of a character's chunks, or None for all chunks
+    def positions(self, character=None):
+        if character is None:
+            return None
+        return self.characters.get(character, []) if self.characters else []
+
+    def size(self, character=None):
+        if self.index is None:
+            return 0
+        positions = self.positions(character)
+        return self.index.index.ntotal if positions is None else len(positions)
+
+    def document(self, position):
+        return self.index.docstore.search(self.index.index_to_docstore_id[position])
+
+    def lexical_search(self, query, k, character=None):
+        if self.index is None:
+            return []
+        return [((self.book, i), score) for i, score in self.lexical_index.search(query, k, self.positions(character))]
+
+    def vector_search(self, query_embedding, k, character=None):
+        if not self.size(character):
+            return []
+        return [((self.book, i), distance) for i, distance in vector_search(self.index, query_embedding, k, self.positions(character))]
+
+
+class ShardedIndex:
+    def __init__(self, embeddings, books=None, shards_dir=SHARDS_DIR, workers=SHARD_WORKERS):
+        self.embeddings = embeddings
+        self.shards_dir = shards_dir
+        self.all_books = books is None
+        self.stale_removed = False
+        if books is None:
+            books = list_books()
+        self.shards = {book: Shard(book, embeddings, shards_dir) for book in books}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard")
+
+    @property
+    def books(self):
+        return list(self.shards)
+
+    def select(self, books=None):
+        if books is None:
+            return list(self.shards.values())
+        unknown = [book for book in books if book not in self.shards]
+        if unknown:
+            raise ValueError(f"Unknown books: {', '.join(unknown)}")
+        return [self.shards[book] for book in books]
+
+    # fn(shard) for every selected shard (loaded first), concurrently, in shard order.
+    # Shards that fail to load are logged and left out of the results.
+    def fan_out(self, fn, books=None):
+        shards = self.select(books)
+        if len(shards) == 1:
+            results = [self.call(fn, shards[0])]
+        else:
+            results = self.executor.map(lambda shard: self.call(fn, shard), shards)
+        return [result for loaded, result in results if loaded]
+
+    # (True, fn(shard)) once the shard is loaded, (False, None) when it cannot be
+    def call(self, fn, shard):
+        try:
+            shard.load()
+        except Exception:
+            logger.exception("Could not load the shard of %s", shard.book)
+            return False, None
+        return True, fn(shard)
+
+    # Load (and build or update) the selected shards, e.g. at startup. The first load of
+    # every book in docs/ also deletes the shards of books that are no longer there.
+    def load(self, books=None):
+        if books is None and self.all_books and not self.stale_removed:
+            self.stale_removed = True
+            remove_stale_shards(self.books, self.shards_dir)
+        self.fan_out(lambda shard: None, books)
+        return self
+
+    def count(self, books=None, character=None):
+        return sum(self.fan_out(lambda shard: shard.size(character), books))
+
+    # Top k ((book, position), BM25 score) pairs. Each shard scores with its own term
+    # statistics, which are close enough between books of one corpus to be merged.
+    def lexical_search(self, query, k=4, books=None, character=None):
+        results = self.fan_out(lambda shard: shard.lexical_search(query, k, character), books)
+        return heapq.nlargest(k, itertools.chain.from_iterable(results), key=lambda result: result[1])
+
+    # Top k ((book, position), distance) pairs; distances of one embedding model compare across shards
+    def vector_search(self, query_embedding, k=4, books=None, character=None):
+        results = self.fan_out(lambda shard: shard.vector_search(query_embedding, k, character), books)
+        merged = itertools.chain.from_iterable(results)
+        if any(shard.index is not None and shard.index.index.metric_type == faiss.METRIC_INNER_PRODUCT for shard in self.select(books)):
+            return heapq.nlargest(k, merged, key=lambda result: result[1])
+        return heapq.nsmallest(k, merged, key=lambda result: result[1])
+
+    # [(chunk, score)] for ((book, position), score) results, in the same order
+    def chunks_at(self, results):
+        return [(self.shards[book].document(position), score) for (book, position), score in results]
+
+    # Top k chunks by reciprocal rank fusion of the merged lexical and vector rankings
+    def fuse(self, lexical, vector, k=4):
+        fused = reciprocal_rank_fusion([position for position, _ in lexical], [position for position, _ in vector])
+        return self.chunks_at(fused[:k])
+
+    # Top k chunks by fusion of BM25 and vector search, each over 2k candidates. Without
+    # a query embedding only the lexical side is used, so no embedding call is needed.
+    def hybrid_search(self, query, query_embedding, k=4, books=None, character=None):
+        lexical = self.lexical_search(query, 2 * k, books, character)
+        if query_embedding is None:
+            return self.chunks_at(lexical[:k])
+        return self.fuse(lexical, self.vector_search(query_embedding, 2 * k, books, character), k)
+
+    # Like FAISS.similarity_search_with_score, over the selected books
+    def similarity_search_with_score(self, query, k=4, books=None, character=None):
+        return self.chunks_at(self.vector_search(self.embeddings.embed_query(query), k, books, character))
+
+    # A random chunk of the selected books, every chunk equally likely
+    def random_chunk(self, books=None):
+        sizes = [(shard, size) for shard, size in self.fan_out(lambda shard: (shard, shard.size()), books) if size]
+        if not sizes:
+            raise ValueError("No chunks in the selected books")
+        shard = random.choices([shard for shard, _ in sizes], weights=[size for _, size in sizes])[0]
+        return self.chunks_at([((shard.book, random.randrange(shard.size())), 0.0)])[0][0]
+
+    # What the selected shards were built from: their common settings and every book's hash
+    def manifest(self, books=None):
+        manifests = self.fan_out(lambda shard: shard.manifest, books)
+        return {
+            "settings": manifests[0]["settings"] if manifests else None,
+            "sources": {name: source for manifest in manifests for name, source in manifest["sources"].items()},
+        }
+
+    # Short hash of the selected shards' settings and book hashes; changes when a book is
+    # replaced or the shards are rebuilt with other settings
+    def fingerprint(self, books=None):
+        manifest = self.manifest(books)
+        payload = {"settings": manifest["settings"], "sources": {name: source["hash"] for name, source in manifest["sources"].items()}}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()[:16]
@@ -0,0 +1,118 @@
+# Process-wide coalescing of identical in-flight LLM requests. The first caller with
+# a given key runs the chain; callers arriving while it runs wait for it instead of
+# starting their own, receive its streamed tokens in their own thread (Streamlit
+# elements can only be updated from their session's thread) and share its result.
+import hashlib
+import threading
+import time
+
+COALESCE_TIMEOUT = 120  # seconds a caller waits for an identical request before giving up
+
+
+# Key of a chain request: operation, normalized question, any extra inputs (character,
+# explore type) and the exact context, i.e. the retrieved chunks after packing
+def request_key(operation, query, context, *inputs):
+    normalized = " ".join(query.lower().split())
+    return (operation, normalized, *inputs, hashlib.sha256(context.encode("utf-8")).hexdigest())
+
+
+class Abandoned(Exception):
+    pass
+
+
+# One in-flight request: tokens streamed so far, then its result or error
+class Flight:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.tokens = []
+        self.finished = False
+        self.result = None
+        self.error = None
+
+    def add_token(self, token):
+        with self.condition:
+            self.tokens.append(token)
+            self.condition.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self.condition:
+            self.finished = True
+            self.result = result
+            self.error = error
+            self.condition.notify_all()
+
+    # LangChain callback that records the leader's tokens for the waiting callers
+    def token_callback(self):
+        from langchain_core.callbacks import BaseCallbackHandler
+        flight = self
+
+        class FlightHandler(BaseCallbackHandler):
+            run_inline = True  # keep tokens in order in async chains
+
+            def on_llm_new_token(self, token, **kwargs):
+                flight.add_token(token)
+        return FlightHandler()
+
+    # Replay and then follow the leader's tokens into callbacks, and return its result
+    def follow(self, callbacks, timeout):
+        deadline = time.monotonic() + timeout
+        seen = 0
+        while True:
+            with self.condition:
+                while len(self.tokens) == seen and not self.finished:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No result after waiting {timeout}s for an identical request")
+                    self.condition.wait(remaining)
+                tokens = self.tokens[seen:]
+                finished = self.finished
+            seen += len(tokens)
+            for token in tokens:
+                for callback in callbacks:
+                    callback.on_llm_new_token(token)
+            if finished:
+                if isinstance(self.error, Exception):
+                    raise self.error
+                if self.error is not None:
+                    # The leader was stopped (e.g. its session reran), not failed: retry
+                    raise Abandoned()
+                return self.result
+
+
+class SingleFlight:
+    def __init__(self, timeout=COALESCE_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    # Run call(token_callback) once for all concurrent callers with the same key.
+    # Returns (result, shared) where shared is True for callers that waited on another.
+    # Errors of the call are raised in every caller.
+    def run(self, key, call, callbacks=None):
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self.flights[key] = Flight()
+            if leader:
+                break
+            try:
+                return flight.follow(callbacks or [], self.timeout), True
+            except Abandoned:
+                continue
+
+        try:
+            result = call(flight.token_callback())
+        except BaseException as e:
+            self.land(key)
+            flight.finish(error=e)
+            raise
+        self.land(key)
+        flight.finish(result=result)
+        return result, False
+
+    # Later requests with this key start a new flight (finished results are not cached here)
+    def land(self, key):
+        with self.lock:
+            del self.flights[key]